@@ -2,16 +2,19 @@
 
 # Script để tạo torrent và magnet link
 import os
+import re
 import sys
 
 # Thêm đường dẫn hiện tại để có thể import các module
 sys.path.append('.')
 
 # Import các module cần thiết
-from tracker.metainfo_manager import create_metainfo
 from node.magnet_utils import create_magnet
 from config import TRACKER_URL
 
+# Dòng gán magnet link trong seeder_test.py / leecher_test.py
+MAGNET_RE = re.compile(r'(magnet\s*=\s*)[\'"][^\'"]*[\'"]')
+
 def main():
     # Đường dẫn đến file cần tạo torrent
     file_path = 'test_file.txt'
@@ -49,12 +52,13 @@ def main():
             content = f.read()
             
         # Thay thế magnet link
-        old_magnet = content.split("magnet = ")[1].split("\n")[0].strip("'\"")
-        content = content.replace(old_magnet, magnet_link)
+        content = MAGNET_RE.sub(lambda m: f"{m.group(1)}'{magnet_link}'", content, count=1)
         
-        # Ghi lại vào file
-        with open(path, 'w') as f:
+        # Ghi ra file tạm rồi thay thế để không bao giờ để lại file ghi dở
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
             f.write(content)
+        os.replace(tmp_path, path)
             
         print(f"Updated magnet link in {path}")
     
@@ -74,119 +78,27 @@ Tạo metainfo files và tính toán info_hash cho torrent
 import os
 import sys
 import json
-import hashlib
+import base64
 from pathlib import Path
+# choose_piece_length vẫn import được từ create_torrent như trước
+from tracker.metainfo_manager import build_metainfo, choose_piece_length, write_metainfo
+from config import TRACKER_URL as _DEFAULT_TRACKER
 
-def calculate_pieces_hash(file_paths, piece_length=512*1024):
-    """
-    Tính toán hash cho từng piece trong torrent
-    
-    Parameters:
-        file_paths (list): Danh sách đường dẫn đến các file
-        piece_length (int): Kích thước mỗi phần
-        
-    Returns:
-        list: Danh sách các hash của từng piece
-    """
-    if isinstance(file_paths, str):
-        file_paths = [file_paths]
-    
-    piece_hashes = []
-    current_piece = b""
-    
-    # Đọc từng file và tính toán hash cho từng piece
-    for file_path in file_paths:
-        with open(file_path, 'rb') as f:
-            while True:
-                data = f.read(piece_length - len(current_piece))
-                if not data:
-                    break
-                
-                current_piece += data
-                
-                if len(current_piece) == piece_length:
-                    # Tính hash cho piece đủ kích thước
-                    piece_hash = hashlib.sha1(current_piece).hexdigest()
-                    piece_hashes.append(piece_hash)
-                    current_piece = b""
-    
-    # Xử lý piece cuối cùng nếu chưa đủ kích thước
-    if current_piece:
-        piece_hash = hashlib.sha1(current_piece).hexdigest()
-        piece_hashes.append(piece_hash)
-    
-    return piece_hashes
-
-def create_metainfo(file_paths, piece_length=512*1024, tracker_url=None, name=None):
+def create_metainfo(file_paths, piece_length=None, tracker_url=None, name=None):
     """
     Tạo metainfo cho một hoặc nhiều file torrent
     
     Parameters:
         file_paths (list): Danh sách đường dẫn đến các file cần tạo metainfo
-        piece_length (int): Kích thước mỗi phần (mặc định 512KB)
+        piece_length (int): Kích thước mỗi phần (mặc định None: tự chọn theo tổng kích thước, xem choose_piece_length)
         tracker_url (str): URL của tracker
         name (str): Tên của torrent, nếu không cung cấp sẽ sử dụng tên thư mục chứa file
         
     Returns:
         tuple: (info_hash, metainfo) - info_hash là mã băm của thông tin torrent, metainfo là dữ liệu metainfo
     """
-    if tracker_url is None:
-        from config import TRACKER_URL
-        tracker_url = TRACKER_URL
-        
-    if isinstance(file_paths, str):
-        file_paths = [file_paths]  # Chuyển đổi string thành list nếu chỉ có một file
-        
-    # Kiểm tra tất cả các file tồn tại
-    for file_path in file_paths:
-        path = Path(file_path)
-        if not path.exists():
-            raise FileNotFoundError(f"File not found: {file_path}")
-    
-    # Tính toán tổng kích thước các file
-    file_infos = []
-    total_size = 0
-    
-    for file_path in file_paths:
-        path = Path(file_path)
-        file_size = path.stat().st_size
-        file_infos.append({
-            "path": str(path.name),
-            "length": file_size
-        })
-        total_size += file_size
-    
-    # Tính toán số lượng phần
-    piece_count = (total_size + piece_length - 1) // piece_length
-    
-    # Xác định tên torrent
-    if name is None:
-        if len(file_paths) == 1:
-            name = Path(file_paths[0]).name
-        else:
-            # Sử dụng tên thư mục chứa nếu các file cùng thư mục
-            common_parent = Path(file_paths[0]).parent
-            name = common_parent.name + "-torrent"
-    
-    # Tạo metainfo
-    metainfo = {
-        "name": name,
-        "piece_length": piece_length,
-        "piece_count": piece_count,
-        "files": file_infos,
-        "tracker": tracker_url
-    }
-    
-    # Tạo piece hashes nếu có
-    piece_hashes = calculate_pieces_hash(file_paths, piece_length)
-    metainfo["pieces"] = piece_hashes
-    
-    # Tính toán info_hash
-    # Sử dụng SHA1 để tạo info_hash
-    info_hash = hashlib.sha1(json.dumps(metainfo, sort_keys=True).encode()).hexdigest()
-    metainfo["info_hash"] = info_hash
-    
-    return info_hash, metainfo
+    tracker_url = tracker_url or _DEFAULT_TRACKER
+    return build_metainfo(file_paths, piece_length, tracker_url, name)
 
 def save_metainfo(metainfo, output_dir="metainfo"):
     """
@@ -205,12 +117,39 @@ def save_metainfo(metainfo, output_dir="metainfo"):
     # Đường dẫn file đầu ra
     output_path = Path(output_dir) / f"{metainfo['name']}.torrent.json"
     
-    # Ghi metainfo vào file JSON
-    with open(output_path, 'w') as f:
-        json.dump(metainfo, f, indent=2)  # indent=2 để dễ đọc hơn
+    # Khối pieces được lưu dưới dạng base64 để ghi được vào JSON
+    data = dict(metainfo)
+    if isinstance(data.get("pieces"), (bytes, bytearray)):
+        data["pieces"] = base64.b64encode(data["pieces"]).decode('ascii')
+    
+    # Ghi nguyên tử (file tạm + fsync + os.replace) như tracker: thư mục đầu ra thường là
+    # tracker/metainfo, nơi tracker có thể đọc file bất cứ lúc nào
+    write_metainfo(output_path, data)
     
     return str(output_path)
 
+def load_metainfo(metainfo_path):
+    """
+    Đọc metainfo từ file JSON đã lưu bởi save_metainfo
+    
+    Parameters:
+        metainfo_path (str): Đường dẫn đến file metainfo
+        
+    Returns:
+        dict: Dữ liệu metainfo, trường pieces được giải mã lại thành bytes
+    """
+    with open(metainfo_path, 'r') as f:
+        metainfo = json.load(f)
+    
+    # File cũ lưu pieces dưới dạng danh sách hex
+    pieces = metainfo.get("pieces")
+    if isinstance(pieces, str):
+        metainfo["pieces"] = base64.b64decode(pieces)
+    elif isinstance(pieces, list):
+        metainfo["pieces"] = b"".join(bytes.fromhex(h) for h in pieces)
+    
+    return metainfo
+
 def create_magnet_link(info_hash, name=None, tracker_url=None):
     """
     Tạo magnet link từ info_hash và các thông số tùy chọn
@@ -223,20 +162,7 @@ def create_magnet_link(info_hash, name=None, tracker_url=None):
     Returns:
         str: Magnet URL
     """
-    from urllib.parse import quote
-    
-    # Tạo magnet URL cơ bản
-    magnet = f"magnet:?xt=urn:btih:{info_hash}"
-    
-    # Thêm tên nếu được cung cấp
-    if name:
-        magnet += f"&dn={quote(name)}"
-    
-    # Thêm tracker URL nếu được cung cấp
-    if tracker_url:
-        magnet += f"&tr={quote(tracker_url)}"
-    
-    return magnet
+    return create_magnet(info_hash, name=name, trackers=[tracker_url] if tracker_url else None)
 
 def main():
     """
@@ -246,12 +172,11 @@ def main():
     python create_torrent.py [-p PIECE_LENGTH] [-t TRACKER_URL] [-n NAME] file1 [file2 ...]
     """
     import argparse
-    from config import TRACKER_URL
     
     parser = argparse.ArgumentParser(description='Create torrent metainfo file')
     parser.add_argument('files', nargs='+', help='File(s) to include in the torrent')
-    parser.add_argument('-p', '--piece-length', type=int, default=512*1024, help='Piece length in bytes (default: 512KB)')
-    parser.add_argument('-t', '--tracker', default=TRACKER_URL, help=f'Tracker URL (default: {TRACKER_URL})')
+    parser.add_argument('-p', '--piece-length', type=int, default=None, help='Piece length in bytes (default: chosen from total size, 256KB-16MB)')
+    parser.add_argument('-t', '--tracker', default=_DEFAULT_TRACKER, help=f'Tracker URL (default: {_DEFAULT_TRACKER})')
     parser.add_argument('-n', '--name', help='Torrent name (default: file name)')
     parser.add_argument('-o', '--output-dir', default='metainfo', help='Output directory (default: metainfo)')
     
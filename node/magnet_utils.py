@@ -1,6 +1,12 @@
 """Utilities for handling magnet links and parsing info_hash"""
 import logging
-from urllib.parse import parse_qs, urlparse
+from functools import lru_cache
+from urllib.parse import quote, unquote_plus
+
+@lru_cache(maxsize=256)
+def _quote(value):
+    """Percent-encode một giá trị trong magnet link (cache lại vì các tracker URL lặp lại rất nhiều)"""
+    return quote(value, safe='')
 
 def parse_magnet(magnet_url):
     """
@@ -15,26 +21,29 @@ def parse_magnet(magnet_url):
     if not magnet_url.startswith('magnet:?'):
         raise ValueError("Invalid magnet URL format")
     
-    # Parse the query string
-    query = magnet_url[8:]  # Remove 'magnet:?'
-    params = parse_qs(query) 
-    
     result = {}
+    trackers = []
     
-    # trích xuất info_hash từ xt (exact topic)
-    if 'xt' in params:
-        for xt in params['xt']:
-            if xt.startswith('urn:btih:'):
-                result['info_hash'] = xt[9:].lower()
-                break
-    
-    # Extract dn (display name)
-    if 'dn' in params:
-        result['name'] = params['dn'][0]
+    # Duyệt query string một lần, chỉ xử lý các khóa cần dùng (xt, dn, tr)
+    for pair in magnet_url[8:].split('&'):  # Bỏ 'magnet:?'
+        key, _, value = pair.partition('=')
+        if not value:
+            continue
+        
+        if key == 'xt':
+            # trích xuất info_hash từ xt (exact topic), info_hash là hex nên không cần unquote
+            if 'info_hash' not in result and value.startswith('urn:btih:'):
+                result['info_hash'] = value[9:].lower()
+        elif key == 'dn':
+            # Extract dn (display name)
+            if 'name' not in result:
+                result['name'] = unquote_plus(value)
+        elif key == 'tr':
+            # Extract tr (tracker URL)
+            trackers.append(unquote_plus(value))
     
-    # Extract tr (tracker URL)
-    if 'tr' in params:
-        result['trackers'] = params['tr']
+    if trackers:
+        result['trackers'] = trackers
     
     # Validate required fields
     if 'info_hash' not in result:
@@ -57,17 +66,15 @@ def create_magnet(info_hash, name=None, trackers=None):
     if not info_hash:
         raise ValueError("info_hash is required")
     
-    # Start with the basic magnet link
-    magnet = f"magnet:?xt=urn:btih:{info_hash}"
+    # Ghép các tham số một lần thay vì nối chuỗi lặp lại
+    parts = [f"xt=urn:btih:{info_hash}"]
     
     # Add display name if provided
     if name:
-        from urllib.parse import quote
-        magnet += f"&dn={quote(name)}"
+        parts.append(f"dn={_quote(name)}")
     
     # Add trackers if provided
     if trackers:
-        for tracker in trackers:
-            magnet += f"&tr={quote(tracker)}"
+        parts.extend(f"tr={_quote(tracker)}" for tracker in trackers)
     
-    return magnet
\ No newline at end of file
+    return "magnet:?" + "&".join(parts)
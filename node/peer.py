@@ -2,27 +2,105 @@
 from pathlib import Path
 from magnet_utils import parse_magnet
 from transfer import PieceManager, ConnectionManager
+import re
 import sys
 import os
 import logging
+from logging.handlers import RotatingFileHandler
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import shutil
+import socket
+import struct
+import secrets
+import selectors
 import json
+import base64
 import threading
+from dataclasses import dataclass, field, replace
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
 
 # Thêm đường dẫn cha vào sys.path để import config.py
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import TRACKER_URL, DEFAULT_PEER_PORT, DEFAULT_PIECE_LENGTH
 
-# Cấu hình logging
+# Cấu hình logging: mặc định INFO (đổi bằng biến môi trường PEER_LOG_LEVEL, ví dụ DEBUG),
+# file log được xoay vòng để không phình to vô hạn
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get("PEER_LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler("peer.log"),
+        RotatingFileHandler("peer.log", maxBytes=10_000_000, backupCount=3),
         logging.StreamHandler()
     ]
 )
+logger = logging.getLogger(__name__)
+
+# Tên file cache metainfo trong thư mục của mỗi torrent (ẩn để không trùng tên file dữ liệu)
+METAINFO_CACHE_NAME = ".metainfo.json"
+# Thời gian (giây) metainfo cache còn hợp lệ trước khi lấy lại từ tracker
+METAINFO_CACHE_TTL = 24 * 3600
+# Timeout (kết nối, đọc) cho các request đến tracker
+TRACKER_TIMEOUT = (3, 10)
+# Tìm info_hash (hex 40 ký tự hoặc base32 32 ký tự) trong magnet URL
+_BTIH_RE = re.compile(r'urn:btih:([0-9a-fA-F]{40}|[A-Za-z2-7]{32})(?![0-9A-Za-z])')
+
+# Chu kỳ (giây) kiểm tra torrent hoàn tất trong vòng lặp lệnh của __main__
+CHECK_INTERVAL = 5.0
+# Thời gian (giây) giữ kết quả get_status()/get_peer_stats() trước khi tính lại
+STATUS_CACHE_TTL = 0.5
+# Khoảng cách tối thiểu (giây) giữa hai lần announce định kỳ của cùng một torrent
+MIN_ANNOUNCE_INTERVAL = 30
+
+# Bộ mã hóa JSON dùng lại: dạng gọn cho payload gửi tracker, dạng thụt lề để hiển thị ở CLI
+_dumps_compact = json.JSONEncoder(separators=(',', ':')).encode
+_dumps_pretty = json.JSONEncoder(indent=2, ensure_ascii=False).encode
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Một peer trong danh sách compact của tracker: 4 byte IPv4 + 2 byte port (big-endian)
+_COMPACT_PEER = struct.Struct("!4sH")
+
+def _decode_peers(peers):
+    """
+    Chuyển danh sách peers trong phản hồi announce về dạng list các dict
+    
+    Parameters:
+        peers (list or str): List dict (mode không nén) hoặc chuỗi base64 của các ô 6 byte (compact)
+        
+    Returns:
+        list: Các dict {'peer_id', 'ip', 'port', 'compact'}; peer compact không có peer_id thật
+            nên dùng "ip:port" làm định danh
+    """
+    if not isinstance(peers, str):
+        return peers
+    blob = base64.b64decode(peers)
+    usable = len(blob) - len(blob) % _COMPACT_PEER.size
+    result = []
+    for packed_ip, port in _COMPACT_PEER.iter_unpack(blob[:usable]):
+        ip = socket.inet_ntoa(packed_ip)
+        result.append({'peer_id': f"{ip}:{port}", 'ip': ip, 'port': port, 'compact': True})
+    return result
+
+# Lấy cùng lúc các số liệu của PieceManager: (progress, bytes_downloaded, bytes_uploaded, bytes_left)
+_piece_stats = attrgetter('progress', 'bytes_downloaded', 'bytes_uploaded', 'bytes_left')
+
+@dataclass(frozen=True, slots=True)
+class TorrentRecord:
+    """
+    Thông tin một torrent đang được theo dõi (bất biến)
+    
+    Thay đổi trạng thái bằng dataclasses.replace rồi gán lại vào Peer.torrents;
+    lock được dùng chung giữa các phiên bản record của cùng một torrent.
+    """
+    info_hash: str
+    piece_manager: PieceManager
+    status: str
+    summary: dict
+    added_time: float
+    metainfo: dict = field(repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
 
 # quản lý torrent, peer_id, repo_dir, active_downloads
 class Peer:
@@ -39,26 +117,78 @@ class Peer:
         self.peer_id = peer_id or self._generate_peer_id()
         self.tracker_url = tracker_url
         self.listening_port = listening_port
-        self.torrents = {}  # nơi lưu trữ torrent thông tin
+        
+        # nơi lưu trữ torrent thông tin: {info_hash: TorrentRecord}.
+        # Record là bất biến; mỗi thay đổi trạng thái tạo record mới và gán lại một lần vào dict
+        # (atomic dưới GIL), nên việc đọc không cần lock
+        self.torrents = {}
         
         # lưu trữ torrent vào thư mục downloads
         self.repo_dir = Path("downloads")
-        os.makedirs(self.repo_dir, exist_ok=True)
+        self.repo_dir.mkdir(parents=True, exist_ok=True)
         
         # theo dõi các download đang hoạt động
         self.active_downloads = {}  # {info_hash: ConnectionManager}
         
-        # Khởi tạo lock để đồng bộ các thread
-        self.lock = threading.Lock()
+        # Lock chung chỉ bảo vệ việc thêm/xóa torrent và self.active_downloads; các thay đổi trạng thái
+        # của một torrent được tuần tự hóa bởi lock riêng của torrent đó (TorrentRecord.lock).
+        # Không giữ lock nào trong khi gửi HTTP đến tracker.
+        self.torrents_lock = threading.Lock()
+        
+        # info_hash của các torrent đang được thêm (đã giữ chỗ nhưng chưa được lưu),
+        # dùng để chặn hai lần thêm đồng thời cùng một torrent
+        self.initializing = set()
+        
+        # Một Session dùng chung cho mọi request đến tracker: giữ kết nối keep-alive trong pool
+        # thay vì mở TCP mới mỗi lần, và giới hạn số socket khi nhiều torrent announce cùng lúc
+        self.session = requests.Session()
+        self.session.mount(tracker_url, HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=1))
+        
+        # Cổng gộp announce cho mỗi torrent: {info_hash: {'lock', 'time', 'peers'}}
+        self._announce_gate = {}
+        
+        # Cache kết quả get_status() (không tham số) và get_peer_stats() trong STATUS_CACHE_TTL giây.
+        # Đặt _status_cache_expiry = 0.0 để bỏ cache khi trạng thái torrent thay đổi
+        self._status_cache = None
+        self._status_cache_expiry = 0.0
+        self._peer_stats_cache = {}  # {info_hash: (expiry, stats)}
+        
+        # Pool thread dùng chung để gửi nhiều announce cùng lúc (trên cùng pool kết nối của session)
+        self._announce_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="announce")
+        
+    def _snapshot_torrents(self):
+        """
+        Sao chép danh sách các TorrentRecord để duyệt
+        
+        list(dict.values()) được thực hiện hoàn toàn trong C dưới GIL nên không cần lock;
+        record là bất biến nên bản sao luôn nhất quán.
+        """
+        return list(self.torrents.values())
+    
+    def _set_status(self, record, status):
+        """
+        Công bố record mới với trạng thái status, phải gọi khi đang giữ record.lock
+        
+        Parameters:
+            record (TorrentRecord): Record của torrent (phiên bản bất kỳ)
+            status (str): Trạng thái mới
+            
+        Returns:
+            TorrentRecord: Record mới, hoặc None nếu torrent đã bị xóa giữa chừng
+        """
+        current = self.torrents.get(record.info_hash)
+        if current is None:
+            return None
+        new_record = replace(current, status=status)
+        self.torrents[record.info_hash] = new_record
+        self._status_cache_expiry = 0.0
+        return new_record
         
     def _generate_peer_id(self):
         """Tạo một ID cho peer"""
         # Tạo ID ngẫu nhiên với định dạng -ST0001-xxxxxxxxxxxx
-        # xxxxxxxxxxxx là 12 ký tự ngẫu nhiên (chữ và số)
-        import random
-        import string
-        random_chars = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(12))
-        return f"-ST0001-{random_chars}"
+        # xxxxxxxxxxxx là 12 ký tự ngẫu nhiên (base64 an toàn cho URL, từ 9 byte ngẫu nhiên của hệ điều hành)
+        return f"-ST0001-{secrets.token_urlsafe(9)}"
     
     def add_torrent_from_magnet(self, magnet_url):
         """
@@ -71,53 +201,94 @@ class Peer:
             str: Info hash của torrent đã thêm hoặc None nếu không thành công
         """
         try:
+            # Đường tắt khi thêm lại torrent đã có: lấy info_hash bằng một regex,
+            # chỉ phân tích đầy đủ magnet URL khi torrent chưa tồn tại
+            match = _BTIH_RE.search(magnet_url)
+            if match:
+                record = self.torrents.get(match.group(1).lower())
+                if record is not None:
+                    return self._readd_existing(record)
+            
             # Phân tích magnet URL để lấy info_hash
             info = parse_magnet(magnet_url)
             info_hash = info['info_hash']
             
-            # Kiểm tra xem torrent đã tồn tại chưa
-            with self.lock:
-                if info_hash in self.torrents:
-                    logging.info(f"Torrent {info_hash} đã tồn tại")
-                    if self.torrents[info_hash]['status'] == 'paused':
-                        return self.resume_torrent(info_hash)
-                    return info_hash
+            # Kiểm tra xem torrent đã tồn tại (hoặc đang được thêm) chưa, và giữ chỗ nếu chưa.
+            # Chỉ bước kiểm tra + giữ chỗ cần lock; lấy metainfo, tạo thư mục, announce đều chạy ngoài lock
+            with self.torrents_lock:
+                record = self.torrents.get(info_hash)
+                initializing = record is None and info_hash in self.initializing
+                if record is None and not initializing:
+                    self.initializing.add(info_hash)
+            
+            if initializing:
+                logger.info("Torrent %s đang được thêm", info_hash)
+                return info_hash
+            
+            if record is not None:
+                return self._readd_existing(record)
+            
+            try:
+                # Lấy metainfo từ cache trên đĩa, nếu không có (hoặc đã cũ) mới hỏi tracker
+                metainfo = self._load_cached_metainfo(info_hash)
+                from_cache = metainfo is not None
+                if not from_cache:
+                    metainfo = self._fetch_metainfo(info_hash)
+                if not metainfo:
+                    logger.error("Không thể lấy metainfo cho %s", info_hash) 
+                    return None
+                    
+                # Tạo thư mục cho torrent
+                torrent_dir = self.repo_dir / info_hash
+                torrent_dir.mkdir(exist_ok=True)
                 
-            # Lấy metainfo từ tracker
-            metainfo = self._fetch_metainfo(info_hash)
-            if not metainfo:
-                logging.error(f"Không thể lấy metainfo cho {info_hash}") 
-                return None
+                # Lưu metainfo vào cache ngay khi thư mục torrent được tạo, để lần khởi động lại
+                # không phải hỏi tracker (kể cả khi chưa tải xong)
+                if not from_cache:
+                    self._cache_metainfo(info_hash, metainfo)
                 
-            # Tạo thư mục cho torrent
-            torrent_dir = self.repo_dir / info_hash
-            os.makedirs(torrent_dir, exist_ok=True)
-            
-            # Tạo PieceManager cho torrent
-            piece_manager = PieceManager(
-                info_hash=info_hash,
-                piece_length=metainfo.get('piece_length', DEFAULT_PIECE_LENGTH),
-                piece_count=metainfo.get('piece_count', 0),
-                files=metainfo.get('files', []),
-                repo_dir=self.repo_dir
-            )
-            
-            # Thiết lập piece hashes nếu có
-            if 'pieces' in metainfo:
-                piece_manager.set_piece_hashes(metainfo['pieces'])
-            
-            # Bắt đầu giao tiếp với tracker để lấy danh sách peers
-            peers = self._announce_to_tracker(info_hash, piece_manager, event="started")
-            
-            # Lưu thông tin torrent vào danh sách torrents
-            with self.lock:
-                self.torrents[info_hash] = {
-                    'metainfo': metainfo,
-                    'piece_manager': piece_manager,
-                    'status': 'started',
-                    'added_time': time.time(),
-                    'peers': []
-                }
+                # Tạo PieceManager cho torrent
+                piece_manager = PieceManager(
+                    info_hash=info_hash,
+                    piece_length=metainfo.get('piece_length', DEFAULT_PIECE_LENGTH),
+                    piece_count=metainfo.get('piece_count', 0),
+                    files=metainfo.get('files', []),
+                    repo_dir=self.repo_dir
+                )
+                
+                # Thiết lập piece hashes nếu có: pieces dạng base64 được giải mã một lần thành khối digest
+                # và giao thẳng cho PieceManager, không tạo danh sách hash trung gian
+                pieces = metainfo.get('pieces')
+                if isinstance(pieces, str):
+                    piece_manager.set_piece_hashes_raw(base64.b64decode(pieces))
+                elif pieces:
+                    piece_manager.set_piece_hashes(pieces)
+                
+                # Bắt đầu giao tiếp với tracker để lấy danh sách peers
+                peers = self._announce_to_tracker(info_hash, piece_manager, event="started")
+                
+                # Lưu thông tin torrent và bỏ giữ chỗ trong cùng một vùng khóa
+                record = TorrentRecord(
+                    info_hash=info_hash,
+                    piece_manager=piece_manager,
+                    status='started',
+                    # Các trường metainfo hay đọc, tính sẵn một lần khi thêm torrent
+                    summary={
+                        'name': metainfo.get('name', 'Unknown'),
+                        'files': metainfo.get('files', [])
+                    },
+                    added_time=time.time(),
+                    metainfo=metainfo
+                )
+                with self.torrents_lock:
+                    self.torrents[info_hash] = record
+                    self.initializing.discard(info_hash)
+                    self._status_cache_expiry = 0.0
+            finally:
+                # Thêm thất bại: bỏ giữ chỗ để lần thêm sau có thể thử lại
+                if info_hash in self.initializing:
+                    with self.torrents_lock:
+                        self.initializing.discard(info_hash)
             
             # Bắt đầu kết nối với peers
             self._start_connections(info_hash, piece_manager, peers)
@@ -125,8 +296,24 @@ class Peer:
             return info_hash
             
         except Exception as e:
-            logging.error(f"Lỗi khi thêm torrent từ magnet URL: {e}")
+            logger.error("Lỗi khi thêm torrent từ magnet URL: %s", e)
+            return None
+    
+    def _readd_existing(self, record):
+        """
+        Xử lý việc thêm lại một torrent đã tồn tại: tiếp tục nếu đang tạm dừng
+        
+        Parameters:
+            record (TorrentRecord): Record của torrent
+            
+        Returns:
+            str: Info hash của torrent, hoặc None nếu không tiếp tục được
+        """
+        logger.info("Torrent %s đã tồn tại", record.info_hash)
+        # resume_torrent tự lấy lock, đọc trạng thái không cần lock
+        if record.status == 'paused' and not self.resume_torrent(record.info_hash):
             return None
+        return record.info_hash
     
     def add_multiple_torrents(self, magnet_urls):
         """
@@ -138,23 +325,15 @@ class Peer:
         Returns:
             list: Danh sách info_hashes đã thêm thành công
         """
-        info_hashes = []
-        
-        # Tạo các thread riêng để thêm torrent song song
-        threads = []
-        for magnet_url in magnet_urls:
-            thread = threading.Thread(
-                target=lambda url, result_list: result_list.append(self.add_torrent_from_magnet(url)),
-                args=(magnet_url, info_hashes)
-            )
-            threads.append(thread)
-            thread.start()
+        if not magnet_urls:
+            return []
         
-        # Chờ tất cả thread hoàn thành
-        for thread in threads:
-            thread.join()
+        # Thêm song song trên một pool có giới hạn số thread; map giữ đúng thứ tự đầu vào
+        # và không cần list dùng chung giữa các thread
+        with ThreadPoolExecutor(max_workers=min(32, len(magnet_urls))) as executor:
+            results = list(executor.map(self.add_torrent_from_magnet, magnet_urls))
                 
-        return [h for h in info_hashes if h is not None]
+        return [h for h in results if h is not None]
 
     def pause_torrent(self, info_hash):
         """
@@ -167,19 +346,28 @@ class Peer:
             bool: True nếu tạm dừng thành công, False nếu không
         """
         try:
-            if info_hash not in self.torrents:
-                logging.warning(f"Torrent {info_hash} không tồn tại")
+            record = self.torrents.get(info_hash)
+            if record is None:
+                logger.warning("Torrent %s không tồn tại", info_hash)
                 return False
+            piece_manager = record.piece_manager
                 
-            with self.lock:
-                # Kiểm tra xem torrent đã tạm dừng chưa
-                if self.torrents[info_hash]['status'] == 'paused':
+            # Đọc và đánh dấu trạng thái trong vùng khóa ngắn
+            with record.lock:
+                current = self.torrents.get(info_hash)
+                # Torrent vừa bị xóa, hoặc đã (đang) tạm dừng
+                if current is None:
+                    return False
+                if current.status in ('paused', 'pausing'):
                     return True
-                    
-                # Gửi sự kiện 'stopped' đến tracker
-                torrent = self.torrents[info_hash]
-                piece_manager = torrent['piece_manager']
-                
+                previous_status = current.status
+                self._set_status(record, 'pausing')
+            
+            with self.torrents_lock:
+                conn_manager = self.active_downloads.pop(info_hash, None)
+            
+            try:
+                # Gửi sự kiện 'stopped' đến tracker (HTTP, không giữ lock)
                 self._announce_to_tracker(
                     info_hash, 
                     piece_manager, 
@@ -187,17 +375,21 @@ class Peer:
                 )
                 
                 # Dừng connection manager
-                if info_hash in self.active_downloads:
-                    self.active_downloads[info_hash].stop()
-                    del self.active_downloads[info_hash]
-                
-                # Cập nhật trạng thái
-                self.torrents[info_hash]['status'] = 'paused'
+                if conn_manager:
+                    conn_manager.stop()
+            except Exception:
+                with record.lock:
+                    self._set_status(record, previous_status)
+                raise
+            
+            # Cập nhật trạng thái
+            with record.lock:
+                self._set_status(record, 'paused')
                 
             return True
             
         except Exception as e:
-            logging.error(f"Lỗi khi tạm dừng torrent {info_hash}: {e}")
+            logger.error("Lỗi khi tạm dừng torrent %s: %s", info_hash, e)
             return False
     
     def resume_torrent(self, info_hash):
@@ -211,20 +403,21 @@ class Peer:
             bool: True nếu tiếp tục thành công, False nếu không
         """
         try:
-            if info_hash not in self.torrents:
-                logging.warning(f"Torrent {info_hash} không tồn tại")
+            record = self.torrents.get(info_hash)
+            if record is None:
+                logger.warning("Torrent %s không tồn tại", info_hash)
                 return False
+            piece_manager = record.piece_manager
                 
-            with self.lock:
-                # Kiểm tra xem torrent đã chạy chưa
-                if self.torrents[info_hash]['status'] == 'started':
+            with record.lock:
+                # Chỉ torrent đang tạm dừng mới cần khởi động lại
+                current = self.torrents.get(info_hash)
+                if current is None or current.status != 'paused':
                     return True
-                    
-                # Khởi động lại quá trình tải xuống
-                torrent = self.torrents[info_hash]
-                piece_manager = torrent['piece_manager']
-                
-                # Gửi sự kiện 'started' đến tracker
+                self._set_status(record, 'resuming')
+            
+            try:
+                # Gửi sự kiện 'started' đến tracker (HTTP, không giữ lock)
                 peers = self._announce_to_tracker(
                     info_hash, 
                     piece_manager, 
@@ -233,14 +426,19 @@ class Peer:
                 
                 # Bắt đầu kết nối với peers
                 self._start_connections(info_hash, piece_manager, peers)
-                
-                # Cập nhật trạng thái
-                self.torrents[info_hash]['status'] = 'started'
+            except Exception:
+                with record.lock:
+                    self._set_status(record, 'paused')
+                raise
+            
+            # Cập nhật trạng thái
+            with record.lock:
+                self._set_status(record, 'started')
                 
             return True
             
         except Exception as e:
-            logging.error(f"Lỗi khi tiếp tục torrent {info_hash}: {e}")
+            logger.error("Lỗi khi tiếp tục torrent %s: %s", info_hash, e)
             return False
     
     def stop_all(self):
@@ -251,19 +449,28 @@ class Peer:
             bool: True nếu dừng thành công, False nếu có lỗi
         """
         try:
-            with self.lock:
-                # Lưu danh sách info_hash để tránh lỗi khi duyệt dict
-                info_hashes = list(self.torrents.keys())
-                
-                for info_hash in info_hashes:
-                    self.pause_torrent(info_hash)
+            # Lấy danh sách info_hash một lần, rồi tạm dừng song song (pause_torrent tự lấy lock),
+            # để announce 'stopped' tới tracker chậm không chặn các torrent khác
+            info_hashes = list(self.torrents)
+            if info_hashes:
+                with ThreadPoolExecutor(max_workers=min(16, len(info_hashes))) as executor:
+                    list(executor.map(self.pause_torrent, info_hashes))
                     
             return True
             
         except Exception as e:
-            logging.error(f"Lỗi khi dừng tất cả torrent: {e}")
+            logger.error("Lỗi khi dừng tất cả torrent: %s", e)
             return False
     
+    def close(self):
+        """
+        Dừng pool announce, đóng Session HTTP và các kết nối keep-alive tới tracker
+        
+        Chỉ gọi khi thoát chương trình (sau stop_all): sau đó Peer không announce được nữa
+        """
+        self._announce_pool.shutdown(wait=True)
+        self.session.close()
+    
     def remove_torrent(self, info_hash, delete_files=False):
         """
         Xóa torrent khỏi danh sách theo dõi
@@ -282,22 +489,26 @@ class Peer:
             # Dừng và thông báo cho tracker
             self.pause_torrent(info_hash)
             
-            with self.lock:
+            with self.torrents_lock:
                 # Xóa khỏi danh sách theo dõi
-                if info_hash in self.torrents:
-                    del self.torrents[info_hash]
+                record = self.torrents.pop(info_hash, None)
+                self._status_cache_expiry = 0.0
+                self._announce_gate.pop(info_hash, None)
+                self._peer_stats_cache.pop(info_hash, None)
+                
+            # Đóng các file đích đang mở của torrent
+            if record is not None:
+                record.piece_manager.close()
                 
-                # Xóa file nếu cần
-                if delete_files:
-                    torrent_dir = self.repo_dir / info_hash
-                    if os.path.exists(torrent_dir):
-                        import shutil
-                        shutil.rmtree(torrent_dir)
+            # Xóa file nếu cần (thao tác đĩa, không giữ lock)
+            # rmtree(ignore_errors=True) tự bỏ qua thư mục không tồn tại, không cần stat trước
+            if delete_files:
+                shutil.rmtree(self.repo_dir / info_hash, ignore_errors=True)
                         
             return True
             
         except Exception as e:
-            logging.error(f"Lỗi khi xóa torrent {info_hash}: {e}")
+            logger.error("Lỗi khi xóa torrent %s: %s", info_hash, e)
             return False
     
     def _fetch_metainfo(self, info_hash):
@@ -311,21 +522,74 @@ class Peer:
             dict: Dữ liệu metainfo nếu tìm thấy, ngược lại trả về None
         """
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.tracker_url}/metainfo",
-                params={'info_hash': info_hash}
+                params={'info_hash': info_hash},
+                timeout=TRACKER_TIMEOUT
             )
             
             if response.status_code == 200:
                 return response.json()
             else:
-                logging.error(f"Không thể lấy metainfo: {response.text}")
+                logger.error("Không thể lấy metainfo: %s", response.text)
                 return None
                 
         except Exception as e:
-            logging.error(f"Lỗi khi lấy metainfo: {e}")
+            logger.error("Lỗi khi lấy metainfo: %s", e)
             return None
     
+    def _load_cached_metainfo(self, info_hash):
+        """
+        Đọc metainfo (kèm piece hashes) từ cache trong thư mục torrent
+        
+        Parameters:
+            info_hash (str): Info hash của torrent
+            
+        Returns:
+            dict: Metainfo đã cache, None nếu không có, hỏng hoặc đã quá METAINFO_CACHE_TTL
+        """
+        cache_path = self.repo_dir / info_hash / METAINFO_CACHE_NAME
+        try:
+            with open(cache_path, 'r') as f:
+                metainfo = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Bỏ qua metainfo cache hỏng %s: %s", cache_path, e)
+            return None
+        
+        cached_at = metainfo.pop('_cached_at', 0)
+        if time.time() - cached_at > METAINFO_CACHE_TTL:
+            return None
+        if metainfo.get('info_hash', info_hash) != info_hash:
+            return None
+        
+        logger.info("Dùng metainfo cache cho %s", info_hash)
+        return metainfo
+    
+    def _cache_metainfo(self, info_hash, metainfo):
+        """
+        Ghi metainfo vào cache trong thư mục torrent (ghi file tạm rồi os.replace để không để lại file dở)
+        
+        Chỉ ghi khi thư mục torrent đã tồn tại, tức là người dùng đã thực sự thêm torrent này.
+        
+        Parameters:
+            info_hash (str): Info hash của torrent
+            metainfo (dict): Dữ liệu metainfo (bao gồm 'pieces' nếu có)
+        """
+        torrent_dir = self.repo_dir / info_hash
+        if not torrent_dir.is_dir():
+            return
+        
+        cache_path = torrent_dir / METAINFO_CACHE_NAME
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({**metainfo, '_cached_at': time.time()}, f, separators=(',', ':'))
+            os.replace(tmp_path, cache_path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Không thể lưu metainfo cache cho %s: %s", info_hash, e)
+    
     def _announce_to_tracker(self, info_hash, piece_manager, event="started"):
         """
         Gửi yêu cầu announce đến tracker để lấy danh sách peers
@@ -358,9 +622,12 @@ class Peer:
             }
             
             # Gửi yêu cầu đến tracker
-            response = requests.post(
+            # Tự mã hóa JSON dạng gọn (không khoảng trắng) thay vì để requests mã hóa qua json=
+            response = self.session.post(
                 f"{self.tracker_url}/announce",
-                json=payload
+                data=_dumps_compact(payload),
+                headers=JSON_HEADERS,
+                timeout=TRACKER_TIMEOUT
             )
             
             if response.status_code == 200:
@@ -368,18 +635,53 @@ class Peer:
                 
                 # Kiểm tra xem có cảnh báo gì không
                 if data.get("warning"):
-                    logging.warning(f"Cảnh báo từ tracker: {data['warning']}")
+                    logger.warning("Cảnh báo từ tracker: %s", data['warning'])
+                
+                # Ghi nhận lần announce thành công để các announce định kỳ gần đó được gộp lại
+                peers = _decode_peers(data.get("peers", []))
+                gate = self._get_announce_gate(info_hash)
+                gate['time'] = time.monotonic()
+                gate['peers'] = peers
                 
                 # Trả về danh sách peers từ phản hồi
-                return data.get("peers", [])
+                return peers
             else:
-                logging.error(f"Announce thất bại: {response.text}")
+                logger.error("Announce thất bại: %s", response.text)
                 return []
                 
         except Exception as e:
-            logging.error(f"Lỗi khi gửi announce đến tracker: {e}")
+            logger.error("Lỗi khi gửi announce đến tracker: %s", e)
             return []
     
+    def _get_announce_gate(self, info_hash):
+        """Lấy (tạo nếu chưa có) cổng gộp announce của torrent"""
+        with self.torrents_lock:
+            gate = self._announce_gate.get(info_hash)
+            if gate is None:
+                gate = self._announce_gate[info_hash] = {'lock': threading.Lock(), 'time': 0.0, 'peers': []}
+            return gate
+    
+    def _throttled_announce(self, info_hash, piece_manager):
+        """
+        Announce định kỳ (không kèm sự kiện mới) với tracker, gộp các lần gọi dồn dập
+        
+        Nếu torrent vừa announce thành công trong vòng MIN_ANNOUNCE_INTERVAL giây thì trả về
+        danh sách peers lần trước thay vì gửi thêm một POST. Lock của cổng đảm bảo các lần gọi
+        đồng thời chỉ tạo ra một request; các lần gọi sau chờ và dùng chung kết quả.
+        
+        Parameters:
+            info_hash (str): Info hash của torrent
+            piece_manager (PieceManager): Quản lý các phần của torrent
+            
+        Returns:
+            list: Danh sách peers từ tracker (hoặc từ lần announce gần nhất)
+        """
+        gate = self._get_announce_gate(info_hash)
+        with gate['lock']:
+            if time.monotonic() - gate['time'] < MIN_ANNOUNCE_INTERVAL:
+                return gate['peers']
+            return self._announce_to_tracker(info_hash, piece_manager)
+    
     def _start_connections(self, info_hash, piece_manager, peers):
         """
         Bắt đầu kết nối đến các peers từ tracker
@@ -395,7 +697,7 @@ class Peer:
                 info_hash=info_hash,
                 piece_manager=piece_manager,
                 peer_id=self.peer_id,
-                announce_callback=lambda: self._announce_to_tracker(info_hash, piece_manager)
+                announce_callback=lambda: self._throttled_announce(info_hash, piece_manager)
             )
             
             # Thêm các peer vào connection manager
@@ -403,16 +705,16 @@ class Peer:
                 connection_manager.add_peer(peer)
                 
             # Lưu vào active_downloads
-            with self.lock:
+            with self.torrents_lock:
                 self.active_downloads[info_hash] = connection_manager
                 
             # Bắt đầu kết nối và tải xuống
             connection_manager.start()
             
-            logging.info(f"Đã bắt đầu kết nối với {len(peers)} peers cho torrent {info_hash}")
+            logger.info("Đã bắt đầu kết nối với %d peers cho torrent %s", len(peers), info_hash)
             
         except Exception as e:
-            logging.error(f"Lỗi khi bắt đầu kết nối đến peers: {e}")
+            logger.error("Lỗi khi bắt đầu kết nối đến peers: %s", e)
     
     def check_all_torrents(self):
         """
@@ -420,25 +722,44 @@ class Peer:
         Gửi yêu cầu announce 'completed' khi tải xong
         """
         try:
-            with self.lock:
-                for info_hash, torrent in self.torrents.items():
-                    piece_manager = torrent['piece_manager']
-                    
-                    # Kiểm tra nếu torrent đã hoàn thành nhưng chưa báo cho tracker
-                    if piece_manager.progress >= 1.0 and torrent['status'] != 'completed':
-                        # Gửi sự kiện 'completed' cho tracker
-                        self._announce_to_tracker(info_hash, piece_manager, event="completed")
-                        
-                        # Cập nhật trạng thái
-                        torrent['status'] = 'completed'
-                        logging.info(f"Torrent {info_hash} đã tải xuống hoàn tất")
-                        
-                    # Nếu torrent đang tạm dừng, bỏ qua
-                    if torrent['status'] == 'paused':
-                        continue
+            completed = []
+            add_completed = completed.append
+            torrents = self.torrents
+            for record in self._snapshot_torrents():
+                piece_manager = record.piece_manager
+                # Kiểm tra (không lock) nếu torrent đã hoàn thành nhưng chưa báo cho tracker
+                if record.status == 'completed' or not piece_manager.is_complete:
+                    continue
+                # Đánh dấu 'completed' dưới lock, để chỉ một luồng gửi announce
+                with record.lock:
+                    current = torrents.get(record.info_hash)
+                    if current is not None and current.status != 'completed':
+                        self._set_status(record, 'completed')
+                        add_completed((record.info_hash, piece_manager))
+            
+            # Gửi các sự kiện 'completed' cho tracker song song (không giữ lock),
+            # tổng thời gian chờ ~1 RTT thay vì N RTT nối tiếp
+            announce = self._announce_to_tracker
+            log_info = logger.info
+            
+            def announce_completed(item):
+                info_hash, piece_manager = item
+                announce(info_hash, piece_manager, event="completed")
+                log_info("Torrent %s đã tải xuống hoàn tất", info_hash)
+            
+            if len(completed) == 1:
+                announce_completed(completed[0])
+            elif completed:
+                list(self._announce_pool.map(announce_completed, completed))
                     
         except Exception as e:
-            logging.error(f"Lỗi khi kiểm tra torrent: {e}")
+            logger.error("Lỗi khi kiểm tra torrent: %s", e)
+    
+    def _connected_handlers(self, conn_manager):
+        """Sao chép danh sách handler của các peer (kèm trạng thái) dưới lock của ConnectionManager"""
+        with conn_manager.lock:
+            return [(peer_id, peer['info'], peer['handler'], peer['connected'])
+                    for peer_id, peer in conn_manager.peers.items()]
     
     def get_status(self, info_hash=None):
         """
@@ -448,60 +769,81 @@ class Peer:
             info_hash (str, optional): Info hash của torrent cụ thể
             
         Returns:
-            dict: Trạng thái của torrent hoặc tất cả các torrent
+            dict: Trạng thái của torrent hoặc tất cả các torrent (dict mới, người gọi được sửa)
         """
         try:
-            with self.lock:
-                if info_hash:
-                    if info_hash not in self.torrents:
-                        return {"error": "Torrent không tồn tại"}
-                        
-                    torrent = self.torrents[info_hash]
-                    piece_manager = torrent['piece_manager']
-                    
-                    # Tính toán tốc độ tải xuống/tải lên
-                    download_speed = 0  # bytes/s
-                    upload_speed = 0    # bytes/s
-                    
-                    if info_hash in self.active_downloads:
-                        conn_manager = self.active_downloads[info_hash]
-                        for peer_id, peer in conn_manager.peers.items():
-                            if peer['handler'] and peer['connected']:
-                                download_speed += peer['handler'].bytes_downloaded
-                                upload_speed += peer['handler'].bytes_uploaded
-                    
-                    return {
-                        "info_hash": info_hash,
-                        "name": torrent['metainfo'].get('name', 'Unknown'),
-                        "progress": piece_manager.progress * 100,
-                        "downloaded": piece_manager.bytes_downloaded,
-                        "uploaded": piece_manager.bytes_uploaded,
-                        "left": piece_manager.bytes_left,
-                        "status": torrent['status'],
-                        "download_speed": download_speed,
-                        "upload_speed": upload_speed,
-                        "files": torrent['metainfo'].get('files', []),
-                        "piece_count": piece_manager.piece_count,
-                        "piece_length": piece_manager.piece_length
+            if info_hash:
+                # Một lần đọc dict, không lock: record bất biến nên các trường luôn nhất quán
+                record = self.torrents.get(info_hash)
+                if record is None:
+                    return {"error": "Torrent không tồn tại"}
+                piece_manager = record.piece_manager
+                summary = record.summary
+                # Tốc độ tải xuống/tải lên (bytes/s) đã được gộp sẵn trên PieceManager
+                now = time.monotonic()
+                download_speed = piece_manager.transfer_rate('down', now)
+                upload_speed = piece_manager.transfer_rate('up', now)
+                
+                progress, downloaded, uploaded, left = _piece_stats(piece_manager)
+                return {
+                    "info_hash": info_hash,
+                    "name": summary['name'],
+                    "progress": progress * 100,
+                    "downloaded": downloaded,
+                    "uploaded": uploaded,
+                    "left": left,
+                    "status": record.status,
+                    "download_speed": download_speed,
+                    "upload_speed": upload_speed,
+                    "files": summary['files'],
+                    "piece_count": piece_manager.piece_count,
+                    "piece_length": piece_manager.piece_length
+                }
+            else:
+                # Kết quả gần đây vẫn còn hạn và không có thay đổi trạng thái nào từ đó
+                now = time.monotonic()
+                if now < self._status_cache_expiry:
+                    # Bản sao nông: người gọi thêm/xóa khóa không làm hỏng cache của các lần đọc sau
+                    return dict(self._status_cache)
+                
+                # Trả về trạng thái của tất cả các torrent, duyệt trên bản sao không cần lock
+                result = {}
+                piece_stats = _piece_stats
+                for record in self._snapshot_torrents():
+                    progress, downloaded, uploaded, left = piece_stats(record.piece_manager)
+                    result[record.info_hash] = {
+                        "name": record.summary['name'],
+                        "progress": progress * 100,
+                        "status": record.status,
+                        "downloaded": downloaded,
+                        "uploaded": uploaded,
+                        "left": left
                     }
-                else:
-                    # Trả về trạng thái của tất cả các torrent
-                    result = {}
-                    for hash, t in self.torrents.items():
-                        result[hash] = {
-                            "name": t['metainfo'].get('name', 'Unknown'),
-                            "progress": t['piece_manager'].progress * 100,
-                            "status": t['status'],
-                            "downloaded": t['piece_manager'].bytes_downloaded,
-                            "uploaded": t['piece_manager'].bytes_uploaded,
-                            "left": t['piece_manager'].bytes_left
-                        }
-                    return result
+                
+                self._status_cache = result
+                self._status_cache_expiry = now + STATUS_CACHE_TTL
+                return dict(result)
         
         except Exception as e:
-            logging.error(f"Lỗi khi lấy trạng thái: {e}")
+            logger.error("Lỗi khi lấy trạng thái: %s", e)
             return {"error": str(e)}
     
+    def get_rate(self, info_hash, direction='down'):
+        """
+        Lấy tốc độ tải hiện tại của một torrent
+        
+        Parameters:
+            info_hash (str): Info hash của torrent
+            direction (str): 'down' (tải xuống) hoặc 'up' (tải lên)
+            
+        Returns:
+            float: Tốc độ (bytes/s), 0 nếu torrent không tồn tại
+        """
+        record = self.torrents.get(info_hash)
+        if record is None:
+            return 0.0
+        return record.piece_manager.transfer_rate(direction)
+    
     def get_peer_stats(self, info_hash):
         """
         Lấy thống kê về các peer đang kết nối
@@ -513,37 +855,125 @@ class Peer:
             list: Danh sách thông tin về các peer
         """
         try:
-            if info_hash not in self.active_downloads:
+            with self.torrents_lock:
+                conn_manager = self.active_downloads.get(info_hash)
+            if conn_manager is None:
                 return []
             
-            stats = []
-            conn_manager = self.active_downloads[info_hash]
+            now = time.monotonic()
+            cached = self._peer_stats_cache.get(info_hash)
+            if cached is not None and now < cached[0]:
+                return list(cached[1])
             
-            with self.lock:
-                for peer_id, peer in conn_manager.peers.items():
-                    if not peer['handler']:
-                        continue
-                    
-                    handler = peer['handler']
-                    stats.append({
-                        "peer_id": peer_id,
-                        "ip": peer['info'].get('ip'),
-                        "port": peer['info'].get('port'),
-                        "connected": peer['connected'],
-                        "downloaded": handler.bytes_downloaded,
-                        "uploaded": handler.bytes_uploaded,
-                        "choking_us": handler.peer_choking,
-                        "we_choking": handler.am_choking,
-                        "pieces": sum(1 for p in handler.peer_bitfield if p),
-                        "last_active": time.time() - handler.last_activity
-                    })
-            
-            return stats
+            stats = []
+            add_stat = stats.append
+            # handler.last_activity là mốc time.monotonic(), đọc đồng hồ một lần cho cả vòng lặp
+            for peer_id, info, handler, connected in self._connected_handlers(conn_manager):
+                if not handler:
+                    continue
+                
+                add_stat({
+                    "peer_id": peer_id,
+                    "ip": info.get('ip'),
+                    "port": info.get('port'),
+                    "connected": connected,
+                    "downloaded": handler.bytes_downloaded,
+                    "uploaded": handler.bytes_uploaded,
+                    "choking_us": handler.peer_choking,
+                    "we_choking": handler.am_choking,
+                    "pieces": handler.peer_piece_count,
+                    "last_active": now - handler.last_activity
+                })
+            
+            self._peer_stats_cache[info_hash] = (now + STATUS_CACHE_TTL, stats)
+            return list(stats)
             
         except Exception as e:
-            logging.error(f"Lỗi khi lấy thống kê peer: {e}")
+            logger.error("Lỗi khi lấy thống kê peer: %s", e)
             return []
 
+def _run_cli_command(peer, cmd):
+    """
+    Thực hiện một lệnh của CLI
+    
+    Returns:
+        bool: False nếu người dùng muốn thoát
+    """
+    if cmd == "status":
+        status = peer.get_status()
+        print(_dumps_pretty(status))
+    elif cmd == "quit":
+        print("Đang thoát...")
+        return False
+    else:
+        print("Lệnh không hợp lệ")
+    return True
+
+def _run_cli_blocking(peer):
+    """
+    Vòng lệnh dùng input() chặn, cho nền tảng không chờ được stdin bằng selector (Windows)
+    
+    check_all_torrents chạy trên một thread nền mỗi CHECK_INTERVAL giây.
+    """
+    stop = threading.Event()
+    
+    def check_loop():
+        while not stop.wait(CHECK_INTERVAL):
+            peer.check_all_torrents()
+    
+    threading.Thread(target=check_loop, name="torrent-check", daemon=True).start()
+    try:
+        while True:
+            print("\nLệnh: status, quit")
+            try:
+                cmd = input("> ").strip().lower()
+            except EOFError:
+                break
+            if not _run_cli_command(peer, cmd):
+                break
+    finally:
+        stop.set()
+
+def _run_cli(peer):
+    """
+    Vòng lệnh của CLI: chờ stdin bằng selector với timeout 1 giây, để check_all_torrents
+    được gọi định kỳ ngay trên luồng chính mà không cần thêm thread
+    """
+    sel = selectors.DefaultSelector()
+    try:
+        sel.register(sys.stdin, selectors.EVENT_READ)
+    except (ValueError, OSError):
+        # Windows: select() chỉ nhận socket, stdin không đăng ký được
+        sel.close()
+        _run_cli_blocking(peer)
+        return
+    
+    last_check = 0.0
+    prompt = True
+    try:
+        while True:
+            if prompt:
+                print("\nLệnh: status, quit")
+                print("> ", end="", flush=True)
+                prompt = False
+            
+            events = sel.select(timeout=1.0)
+            now = time.monotonic()
+            if now - last_check >= CHECK_INTERVAL:
+                peer.check_all_torrents()
+                last_check = now
+            if not events:
+                continue
+            
+            line = sys.stdin.readline()
+            if not line:  # EOF
+                break
+            prompt = True
+            if not _run_cli_command(peer, line.strip().lower()):
+                break
+    finally:
+        sel.close()
+
 if __name__ == "__main__":
     # Khởi tạo peer
     peer = Peer()
@@ -557,23 +987,12 @@ if __name__ == "__main__":
         
         # Chạy vòng lặp để theo dõi trạng thái torrent
         try:
-            while True:
-                print("\nLệnh: status, quit")
-                cmd = input("> ").strip().lower()
-                
-                if cmd == "status":
-                    status = peer.get_status()
-                    print(json.dumps(status, indent=2))
-                elif cmd == "quit":
-                    print("Đang thoát...")
-                    break
-                else:
-                    print("Lệnh không hợp lệ")
-                    
+            _run_cli(peer)
         except KeyboardInterrupt:
             print("\nĐang thoát...")
             
-        # Kết thúc tất cả các kết nối đang hoạt động
+        # Kết thúc tất cả các kết nối đang hoạt động, rồi đóng kết nối tới tracker
         peer.stop_all()
+        peer.close()
     else:
-        print("Không thể thêm torrent.")
\ No newline at end of file
+        print("Không thể thêm torrent.")
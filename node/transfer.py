@@ -1,12 +1,146 @@
 """Handle file transfers, piece management, and peer connections"""
 import os
+import re
+import mmap
 import time
+import array
+import base64
+import random
 import socket
+import struct
 import logging
 import hashlib
+import selectors
 import threading
+from bisect import bisect_right
 from pathlib import Path
+from itertools import accumulate
 from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# File lưu bitfield các piece đã ghi, để tiếp tục tải những piece không có hash kiểm tra
+RESUME_FILE_NAME = ".bitfield"
+
+if hasattr(os, "pwrite"):
+    _pread = os.pread
+    _pwrite = os.pwrite
+else:
+    # Windows không có pread/pwrite: seek + read/write, khóa lại để các thread không giẫm vị trí của nhau
+    _seek_lock = threading.Lock()
+
+    def _pread(fd, n, offset):
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, n)
+
+    def _pwrite(fd, data, offset):
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+# Tìm nhanh các byte khác 0 trong bitfield (chạy trong C thay vì duyệt từng byte bằng Python)
+_NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+
+# Kích thước buffer gửi/nhận của socket peer: đủ lớn để giữ nhiều dữ liệu đang truyền trên đường RTT dài
+SOCKET_BUFFER_SIZE = 4 << 20
+# TCP_QUICKACK (chỉ có trên Linux) bị kernel tự tắt lại, nên được bật lại sau mỗi lần recv
+_TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", None)
+
+
+def _tune_peer_socket(sock):
+    """
+    Set the options used on every peer socket
+    
+    TCP_NODELAY sends small control messages (interested, have, request) immediately
+    instead of waiting for Nagle, and larger SO_SNDBUF/SO_RCVBUF keep more piece data in
+    flight. Must be applied before connect/listen so the TCP window scale is negotiated.
+    
+    Parameters:
+        sock (socket.socket): TCP socket
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        logging.debug(f"Could not set TCP_NODELAY: {e}")
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+        except OSError as e:
+            logging.debug(f"Could not set socket buffer size: {e}")
+
+
+def _send_buffers(sock, buffers):
+    """
+    Send a list of buffers as one message
+    
+    Uses socket.sendmsg (scatter-gather, no concatenation) and resumes after partial sends;
+    falls back to sendall of the joined buffers where sendmsg is unavailable (Windows).
+    
+    Parameters:
+        sock (socket.socket): Connected socket
+        buffers (list): bytes-like objects, sent in order
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(b).cast('B') for b in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+
+class _DescriptorFile:
+    """
+    Read-only file object over a shared descriptor, for socket.sendfile
+    
+    socket.sendfile only needs fileno() for os.sendfile and seek()/read() for its
+    send() fallback; reads use pread so the shared descriptor's position never matters.
+    """
+    
+    def __init__(self, fd):
+        self._fd = fd
+        self._pos = 0
+    
+    def fileno(self):
+        return self._fd
+    
+    def seek(self, pos, whence=os.SEEK_SET):
+        self._pos = pos
+        return pos
+    
+    def read(self, n):
+        data = _pread(self._fd, n, self._pos)
+        self._pos += len(data)
+        return data
+
+
+def _bit_indexes(mask, nbytes):
+    """
+    Expand a big-endian piece mask into the list of piece indexes whose bit is set
+    
+    Parameters:
+        mask (int): Bitfield as an integer, piece 0 in the most significant bit
+        nbytes (int): Length of the bitfield in bytes
+        
+    Returns:
+        list: Piece indexes in ascending order
+    """
+    data = mask.to_bytes(nbytes, 'big')
+    indexes = []
+    for match in _NONZERO_BYTE.finditer(data):
+        pos = match.start()
+        byte = data[pos]
+        base = pos << 3
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                indexes.append(base + bit)
+    return indexes
+
 
 class PieceManager:
     """Manages pieces of a torrent, tracks which are downloaded and needed"""
@@ -32,88 +166,532 @@ class PieceManager:
         self.torrent_dir = repo_dir / info_hash
         os.makedirs(self.torrent_dir, exist_ok=True)
         
-        # Track piece status
-        self.have_pieces = [False] * piece_count
-        self.requested_pieces = set()
-        
-        # Track piece hashes for verification (loaded from metainfo)
-        self.piece_hashes = []
+        # Piece được ghi thẳng vào các file đích: vị trí bắt đầu của từng file trong
+        # dòng dữ liệu của torrent dùng để map piece -> (file, offset)
+        self._file_starts = list(accumulate((f['length'] for f in files), initial=0))
+        # Tổng kích thước không đổi trong suốt vòng đời torrent, tính một lần
+        self.total_size = self._file_starts[-1]
+        self._fds = {}
+        self._fd_lock = threading.Lock()
+        self._resume_fd = None
+        
+        # Chế độ chỉ seed: đã đủ mọi piece, upload đọc thẳng từ mmap của các file đích
+        self.seed_mode = False
+        self._seed_maps = None
+        
+        # Track piece status: bitfield đóng gói giống định dạng BITFIELD trên wire,
+        # bit cao nhất của byte 0 là piece 0
+        self.have_pieces = bytearray((piece_count + 7) // 8)
+        # Số piece đã có, cập nhật trong _set_have để progress/is_complete không phải đếm lại
+        self.have_count = 0
+        # Bản bytes của have_pieces để gửi BITFIELD, dựng lại chỉ khi có bit thay đổi
+        self._bitfield_cache = None
+        # Các piece đã gửi request, cùng định dạng bitfield với have_pieces để kết hợp bằng phép bit
+        self.requested_pieces = bytearray(len(self.have_pieces))
+        
+        # Số peer đang kết nối có từng piece, dùng cho rarest-first thật sự
+        self.piece_availability = array.array('I', bytes(4 * piece_count))
+        # Bộ sinh ngẫu nhiên riêng của torrent để chọn ngẫu nhiên giữa các piece hiếm như nhau
+        self._random = random.Random()
+        
+        # Track piece hashes for verification (loaded from metainfo):
+        # raw 20-byte SHA-1 digests concatenated, piece i at [20*i, 20*i+20)
+        self.piece_hashes = b""
         
         # Track statistics
         self.bytes_downloaded = 0
         self.bytes_uploaded = 0
+        # Tốc độ tải xuống/tải lên của cả torrent (EWMA, byte/giây), gộp từ mọi peer.
+        # Phía tải xuống chỉ thread reactor cập nhật; phía tải lên được các thread gửi cập nhật
+        # qua record_upload (dưới _upload_lock). Giao diện đọc trực tiếp
+        self._dl_rate_ewma = 0.0
+        self._ul_rate_ewma = 0.0
+        self._dl_sample_time = self._ul_sample_time = time.monotonic()
+        self._upload_lock = threading.Lock()
         
         # Check for existing data
         self._check_existing_data()
         
         # For thread safety
         self.lock = threading.Lock()
+        
+        # Báo cho các vòng lặp đang chờ (End Game) mỗi khi có thêm piece
+        self.progress_cv = threading.Condition()
+        
+        # Pool kiểm tra SHA-1 và ghi piece nhận được, tách khỏi thread nhận dữ liệu
+        self._verify_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                               thread_name_prefix="verify")
     
     def set_piece_hashes(self, hashes):
-        """Set the expected SHA-1 hashes for each piece"""
-        self.piece_hashes = hashes
+        """
+        Set the expected SHA-1 hashes for each piece
+        
+        Parameters:
+            hashes (str or list): Base64 of the concatenated 20-byte piece digests,
+                or a list of hex digests (older metainfo files)
+        """
+        if isinstance(hashes, str):
+            self.set_piece_hashes_raw(base64.b64decode(hashes))
+        else:
+            self.set_piece_hashes_raw(b"".join(bytes.fromhex(h) for h in hashes))
+    
+    def set_piece_hashes_raw(self, raw):
+        """
+        Set the expected SHA-1 hashes from the raw concatenated digests
+        
+        The blob is kept as is and sliced per piece on verification, no per-piece objects are created.
+        
+        Parameters:
+            raw (bytes): Concatenated 20-byte piece digests
+        """
+        self.piece_hashes = bytes(raw)
+        # Dữ liệu cũ được quét trong __init__ khi chưa có hash, giờ kiểm tra lại bằng digest thật
+        self._check_existing_data()
+    
+    @property
+    def hash_count(self):
+        """Number of pieces with a known expected hash"""
+        return len(self.piece_hashes) // 20
         
     def _check_existing_data(self):
         """Check for existing downloaded pieces"""
-        # In a real implementation, you would check piece hashes
-        # and mark pieces as downloaded if they match
+        # Dữ liệu nằm ngay trong các file đích. Piece có hash thì kiểm tra lại bằng SHA-1;
+        # piece không có hash chỉ tin vào bitfield đã lưu, vì file được cấp phát trước
+        # có thể còn những vùng chưa tải
+        verifiable = min(self.hash_count, self.piece_count)
+        saved = self._load_resume_bitfield()
+        for i in range(verifiable, self.piece_count):
+            self._set_have(i, bool(saved[i >> 3] & (0x80 >> (i & 7))) if saved else False)
+        
+        to_verify = list(range(verifiable)) if self._has_backing_files() else []
+        
+        # hashlib nhả GIL khi hash buffer lớn, nên nhiều thread đọc đĩa và hash song song thật sự
+        if len(to_verify) > 1:
+            with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, len(to_verify))) as pool:
+                results = pool.map(self._verify_stored_piece, to_verify)
+                for i, valid in zip(to_verify, results):
+                    self._set_have(i, valid)
+        else:
+            for i in range(verifiable):
+                self._set_have(i, bool(to_verify) and self._verify_stored_piece(i))
+        
+        # Downloaded bytes = tổng kích thước các piece đã có
+        self.bytes_downloaded = sum(self._piece_size(i) for i in range(self.piece_count) if self._has(i))
+        
+        # Đã có đủ dữ liệu ngay từ đầu: chỉ seed, không cần ghi gì thêm xuống đĩa
+        self.seed_mode = self.piece_count > 0 and self.is_complete
+    
+    def _has(self, piece_index):
+        """Return True if the piece is marked as downloaded in the bitfield"""
+        return bool(self.have_pieces[piece_index >> 3] & (0x80 >> (piece_index & 7)))
+    
+    def _set_have(self, piece_index, have=True):
+        """
+        Set or clear a piece bit in the bitfield, keeping the downloaded count in step
         
-        # Simplified: Just check if files exist and estimate progress
-        total_expected_size = sum(f['length'] for f in self.files)
-        total_existing_size = 0
+        Parameters:
+            piece_index (int): Index of the piece
+            have (bool): True to mark the piece as downloaded, False to clear it
+        """
+        mask = 0x80 >> (piece_index & 7)
+        byte_index = piece_index >> 3
+        if bool(self.have_pieces[byte_index] & mask) == have:
+            return
+        if have:
+            self.have_pieces[byte_index] |= mask
+            self.have_count += 1
+        else:
+            self.have_pieces[byte_index] &= ~mask
+            self.have_count -= 1
+        self._bitfield_cache = None
+    
+    def bitfield_bytes(self):
+        """
+        Snapshot of have_pieces for a BITFIELD message
         
-        for file_info in self.files:
-            file_path = self.torrent_dir / file_info['path']
-            if file_path.exists():
-                total_existing_size += file_path.stat().st_size
-                
-            # Kiểm tra các piece đã tải
-            for i in range(self.piece_count):
-                piece_file = self.torrent_dir / f"piece_{i}.tmp"
-                if piece_file.exists():
-                    # Kiểm tra nếu có hashes để verify
-                    if self.piece_hashes and i < len(self.piece_hashes):
-                        with open(piece_file, 'rb') as f:
-                            data = f.read()
-                            if self.verify_piece(i, data):
-                                self.have_pieces[i] = True
-                    else:
-                        # Nếu không có hash để xác minh, đánh dấu là đã có
-                        self.have_pieces[i] = True
-        
-        # Estimate downloaded bytes
-        if total_expected_size > 0:
-            self.bytes_downloaded = min(total_existing_size, total_expected_size)
+        Returns:
+            bytes: Packed bitfield, reused until a piece bit changes
+        """
+        cache = self._bitfield_cache
+        if cache is None:
+            cache = self._bitfield_cache = bytes(self.have_pieces)
+        return cache
+    
+    def has_piece(self, piece_index):
+        """
+        Check whether a piece has been downloaded and verified
+        
+        Parameters:
+            piece_index (int): Index of the piece
+            
+        Returns:
+            bool: True if we have the piece, False otherwise (also for out-of-range indexes)
+        """
+        return 0 <= piece_index < self.piece_count and self._has(piece_index)
+    
+    @property
+    def is_complete(self):
+        """True once every piece has been downloaded"""
+        return self.have_count == self.piece_count
+    
+    def _set_requested(self, piece_index, requested=True):
+        """Set or clear the requested bit of a piece"""
+        mask = 0x80 >> (piece_index & 7)
+        if requested:
+            self.requested_pieces[piece_index >> 3] |= mask
+        else:
+            self.requested_pieces[piece_index >> 3] &= ~mask
+    
+    def is_requested(self, piece_index):
+        """Return True if the piece is currently requested from some peer"""
+        return bool(self.requested_pieces[piece_index >> 3] & (0x80 >> (piece_index & 7)))
+    
+    def missing_pieces(self):
+        """
+        List pieces we do not have and have not requested yet
+        
+        Computed as NOT have AND NOT requested over the whole bitfield in one integer expression.
+        
+        Returns:
+            list: Indexes of missing, unrequested pieces
+        """
+        nbytes = len(self.have_pieces)
+        all_pieces = ((1 << self.piece_count) - 1) << (nbytes * 8 - self.piece_count)
+        mask = all_pieces & ~(int.from_bytes(self.have_pieces, 'big') |
+                              int.from_bytes(self.requested_pieces, 'big'))
+        return _bit_indexes(mask, nbytes)
+    
+    def _piece_size(self, piece_index):
+        """Length of a piece, the last one may be shorter than piece_length"""
+        start = piece_index * self.piece_length
+        return max(0, min(self.piece_length, self.total_size - start))
+    
+    def _spans(self, offset, length):
+        """
+        Map a range of the torrent byte stream onto the files that hold it
+        
+        Parameters:
+            offset (int): Offset in the concatenation of all files
+            length (int): Number of bytes
+            
+        Returns:
+            list: (file_index, file_offset, count) tuples in order
+        """
+        starts = self._file_starts
+        spans = []
+        index = bisect_right(starts, offset) - 1
+        while length > 0 and index < len(self.files):
+            count = min(length, starts[index + 1] - offset)
+            if count > 0:
+                spans.append((index, offset - starts[index], count))
+                offset += count
+                length -= count
+            index += 1
+        return spans
+    
+    def _has_backing_files(self):
+        """True if at least one of the torrent files is already on disk"""
+        return any((self.torrent_dir / f['path']).exists() for f in self.files)
+    
+    def _backing_fd(self, file_index, create=True):
+        """
+        Return the open descriptor of a torrent file, opening it on first use
+        
+        A newly opened file is grown to its final length (posix_fallocate when available,
+        otherwise a sparse ftruncate) so pieces can be written at their final offset.
+        
+        Parameters:
+            file_index (int): Index into self.files
+            create (bool): Create the file if it does not exist yet
+            
+        Returns:
+            int or None: File descriptor, or None if create is False and the file is missing
+        """
+        fd = self._fds.get(file_index)
+        if fd is not None:
+            return fd
+        with self._fd_lock:
+            fd = self._fds.get(file_index)
+            if fd is not None:
+                return fd
+            file_info = self.files[file_index]
+            path = self.torrent_dir / file_info['path']
+            if not create and not path.exists():
+                return None
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+            size = os.fstat(fd).st_size
+            if size < file_info['length']:
+                try:
+                    os.posix_fallocate(fd, size, file_info['length'] - size)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, file_info['length'])
+            self._fds[file_index] = fd
+            return fd
+    
+    def _read_range(self, offset, length):
+        """
+        Read a range of the torrent byte stream from the backing files
+        
+        Returns:
+            bytes or None: The data, or None if a file is missing or too short
+        """
+        parts = []
+        for file_index, file_offset, count in self._spans(offset, length):
+            fd = self._backing_fd(file_index, create=False)
+            if fd is None:
+                return None
+            while count > 0:
+                data = _pread(fd, count, file_offset)
+                if not data:
+                    return None
+                parts.append(data)
+                file_offset += len(data)
+                count -= len(data)
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+    
+    def _write_range(self, offset, data):
+        """Write data at a range of the torrent byte stream, straight into the backing files"""
+        view = memoryview(data)
+        pos = 0
+        for file_index, file_offset, count in self._spans(offset, len(view)):
+            fd = self._backing_fd(file_index)
+            end = pos + count
+            while pos < end:
+                written = _pwrite(fd, view[pos:end], file_offset)
+                pos += written
+                file_offset += written
+    
+    def _load_resume_bitfield(self):
+        """Read the saved bitfield of written pieces, or None if there is none"""
+        try:
+            saved = (self.torrent_dir / RESUME_FILE_NAME).read_bytes()
+        except OSError:
+            return None
+        return saved if len(saved) == len(self.have_pieces) else None
+    
+    def _save_have(self, piece_index):
+        """Persist the bitfield byte of a piece (one pwrite of a single byte)"""
+        if self._resume_fd is None:
+            self._resume_fd = os.open(self.torrent_dir / RESUME_FILE_NAME,
+                                      os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+            os.ftruncate(self._resume_fd, len(self.have_pieces))
+        byte_index = piece_index >> 3
+        _pwrite(self._resume_fd, self.have_pieces[byte_index:byte_index + 1], byte_index)
+    
+    def _verify_stored_piece(self, piece_index):
+        """
+        Verify a piece already stored in the backing files
+        
+        Parameters:
+            piece_index (int): Index of the piece
+            
+        Returns:
+            bool: True if the stored data matches the expected hash
+        """
+        data = self._read_range(piece_index * self.piece_length, self._piece_size(piece_index))
+        return data is not None and self.verify_piece(piece_index, data)
+    
+    def read_block(self, piece_index, begin, length):
+        """
+        Read a block of a piece we have, for uploading to a peer
+        
+        Parameters:
+            piece_index (int): Index of the piece
+            begin (int): Offset inside the piece
+            length (int): Number of bytes
+            
+        Returns:
+            bytes or memoryview or None: The block (a view of the file mapping in seed mode),
+                or None if it is outside the piece or cannot be read
+        """
+        if begin < 0 or length < 0 or begin + length > self._piece_size(piece_index):
+            return None
+        offset = piece_index * self.piece_length + begin
+        if self.seed_mode:
+            maps = self._get_seed_maps()
+            if maps is not None:
+                spans = self._spans(offset, length)
+                if len(spans) == 1:
+                    # Block nằm gọn trong một file: trả về memoryview của mmap, không copy
+                    file_index, file_offset, count = spans[0]
+                    return memoryview(maps[file_index])[file_offset:file_offset + count]
+                return b"".join(maps[i][o:o + c] for i, o, c in spans)
+        return self._read_range(offset, length)
+    
+    def block_file_spans(self, piece_index, begin, length):
+        """
+        Locate a block of a piece we have inside the backing files, for sending with sendfile
+        
+        Parameters:
+            piece_index (int): Index of the piece
+            begin (int): Offset inside the piece
+            length (int): Number of bytes
+            
+        Returns:
+            list or None: (fd, file_offset, count) tuples in order, or None if the block is
+                outside the piece or a file is missing
+        """
+        if begin < 0 or length < 0 or begin + length > self._piece_size(piece_index):
+            return None
+        spans = []
+        for file_index, file_offset, count in self._spans(piece_index * self.piece_length + begin, length):
+            fd = self._backing_fd(file_index, create=False)
+            if fd is None:
+                return None
+            spans.append((fd, file_offset, count))
+        return spans
+    
+    def _get_seed_maps(self):
+        """
+        Map every non-empty torrent file read-only once, for serving uploads in seed mode
+        
+        MAP_POPULATE (Linux) pre-faults the pages so the OS caches the whole file up front.
+        
+        Returns:
+            dict or None: file_index -> mmap, or None if the files cannot be mapped
+        """
+        if self._seed_maps is not None:
+            return self._seed_maps
+        with self._fd_lock:
+            if self._seed_maps is None:
+                maps = {}
+                try:
+                    for file_index, file_info in enumerate(self.files):
+                        if file_info['length'] == 0:
+                            continue
+                        with open(self.torrent_dir / file_info['path'], 'rb') as f:
+                            if hasattr(mmap, "MAP_SHARED"):
+                                flags = mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0)
+                                maps[file_index] = mmap.mmap(f.fileno(), file_info['length'],
+                                                             flags=flags, prot=mmap.PROT_READ)
+                            else:
+                                maps[file_index] = mmap.mmap(f.fileno(), file_info['length'],
+                                                             access=mmap.ACCESS_READ)
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Could not map files for seeding, reading from disk instead: {e}")
+                    for mm in maps.values():
+                        mm.close()
+                    self.seed_mode = False
+                    return None
+                self._seed_maps = maps
+        return self._seed_maps
+    
+    def close(self):
+        """Wait for pending piece writes and close the backing file descriptors"""
+        self._verify_pool.shutdown(wait=True)
+        with self._fd_lock:
+            for mm in (self._seed_maps or {}).values():
+                try:
+                    mm.close()
+                except BufferError:
+                    # Vẫn còn memoryview đang gửi dở, mmap được giải phóng khi view cuối cùng mất
+                    pass
+            self._seed_maps = None
+            fds = list(self._fds.values())
+            self._fds.clear()
+            if self._resume_fd is not None:
+                fds.append(self._resume_fd)
+                self._resume_fd = None
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
     
     @property
     def bytes_left(self):
         """Calculate bytes left to download"""
-        total_size = sum(f['length'] for f in self.files)
-        return max(0, total_size - self.bytes_downloaded)
+        return max(0, self.total_size - self.bytes_downloaded)
     
     @property
     def progress(self):
         """Calculate download progress (0.0 to 1.0)"""
         if self.piece_count == 0:
             return 1.0
-        return sum(1 for p in self.have_pieces if p) / self.piece_count
+        return self.have_count / self.piece_count
+    
+    def record_transfer(self, nbytes, upload=False, now=None):
+        """
+        Fold a block sent or received by any peer into the torrent-wide EWMA rate
+        
+        Parameters:
+            nbytes (int): Size of the block
+            upload (bool): True for a block we sent, False for one we received
+            now (float): time.monotonic() value, if the caller already read the clock
+        """
+        if now is None:
+            now = time.monotonic()
+        if upload:
+            elapsed = max(now - self._ul_sample_time, 1e-3)
+            self._ul_rate_ewma = 0.7 * self._ul_rate_ewma + 0.3 * (nbytes / elapsed)
+            self._ul_sample_time = now
+        else:
+            elapsed = max(now - self._dl_sample_time, 1e-3)
+            self._dl_rate_ewma = 0.7 * self._dl_rate_ewma + 0.3 * (nbytes / elapsed)
+            self._dl_sample_time = now
+    
+    def record_upload(self, nbytes):
+        """
+        Count a block that was sent to a peer (called from the send pool threads)
+        
+        Parameters:
+            nbytes (int): Size of the block
+        """
+        with self._upload_lock:
+            self.bytes_uploaded += nbytes
+            self.record_transfer(nbytes, upload=True)
+    
+    def transfer_rate(self, direction='down', now=None):
+        """
+        Current torrent-wide transfer rate
+        
+        Parameters:
+            direction (str): 'down' or 'up'
+            now (float): time.monotonic() value, read once by callers
+            
+        Returns:
+            float: EWMA rate in bytes/second, 0 if idle for RATE_IDLE_TIMEOUT seconds
+        """
+        if now is None:
+            now = time.monotonic()
+        if direction == 'up':
+            rate, sample_time = self._ul_rate_ewma, self._ul_sample_time
+        else:
+            rate, sample_time = self._dl_rate_ewma, self._dl_sample_time
+        if now - sample_time > RATE_IDLE_TIMEOUT:
+            return 0.0
+        return rate
+    
+    def needed_mask(self, peer_bitfield):
+        """
+        Pieces the peer has and we do not, as one integer mask
+        
+        Parameters:
+            peer_bitfield (bytes or bytearray): Packed bitfield of the peer, same layout as have_pieces
+            
+        Returns:
+            int: Big-endian mask, non-zero if the peer has something we need
+        """
+        return int.from_bytes(peer_bitfield, 'big') & ~int.from_bytes(self.have_pieces, 'big')
     
     def get_next_request(self, peer_has_pieces):
         """
         Get next piece to request from a peer
         
         Parameters:
-            peer_has_pieces (list): Boolean list of pieces the peer has
+            peer_has_pieces (bytes or bytearray): Packed bitfield of the pieces the peer has
             
         Returns:
             int or None: Next piece index to request or None if none available
         """
         with self.lock:
-            # Find pieces that we need and the peer has
-            candidates = []
-            for i in range(self.piece_count):
-                if not self.have_pieces[i] and i not in self.requested_pieces and peer_has_pieces[i]:
-                    candidates.append(i)
+            # Find pieces that we need and the peer has: peer AND NOT have AND NOT requested,
+            # tính trên số nguyên lớn thay vì duyệt từng piece
+            mask = self.needed_mask(peer_has_pieces) & ~int.from_bytes(self.requested_pieces, 'big')
+            if not mask:
+                return None
+            candidates = _bit_indexes(mask, len(self.have_pieces))
             
             if not candidates:
                 return None
@@ -121,18 +699,46 @@ class PieceManager:
             # Use rarest-first strategy instead of just picking the first piece
             rarest_piece = self.get_rarest_piece(candidates)
             if rarest_piece is not None:
-                self.requested_pieces.add(rarest_piece)
+                self._set_requested(rarest_piece)
                 return rarest_piece
                 
             # Fallback to first piece if rarest strategy fails
             piece_index = candidates[0]
-            self.requested_pieces.add(piece_index)
+            self._set_requested(piece_index)
             return piece_index
     
+    def add_availability(self, pieces):
+        """
+        Count newly advertised pieces of a peer (from BITFIELD or HAVE)
+        
+        Parameters:
+            pieces (iterable): Piece indexes the peer just announced
+        """
+        availability = self.piece_availability
+        with self.lock:
+            for i in pieces:
+                availability[i] += 1
+    
+    def remove_availability(self, peer_bitfield):
+        """
+        Stop counting the pieces of a peer that disconnected
+        
+        Parameters:
+            peer_bitfield (bytes or bytearray): Packed bitfield the peer had advertised
+        """
+        availability = self.piece_availability
+        with self.lock:
+            for i in _bit_indexes(int.from_bytes(peer_bitfield, 'big'), len(peer_bitfield)):
+                if availability[i]:
+                    availability[i] -= 1
+    
     def get_rarest_piece(self, candidates):
         """
         Finds the rarest piece among candidates using the Rarest First strategy
         
+        Pieces held by the fewest connected peers win, ties are broken randomly so
+        several peers do not all start on the same piece.
+        
         Parameters:
             candidates (list): List of candidate piece indexes
             
@@ -142,11 +748,9 @@ class PieceManager:
         if not candidates:
             return None
             
-        # In a full implementation, we would track how many peers have each piece
-        # For this implementation, we'll use a simple randomization to distribute requests
-        # which is better than sequential for bandwidth utilization in MDDT
-        import random
-        return random.choice(candidates)
+        availability = self.piece_availability
+        rarest = min(availability[i] for i in candidates)
+        return self._random.choice([i for i in candidates if availability[i] == rarest])
     
     def verify_piece(self, piece_index, data):
         """
@@ -154,137 +758,108 @@ class PieceManager:
         
         Parameters:
             piece_index (int): Index of the piece
-            data (bytes): Piece data
+            data (bytes or memoryview): Piece data, hashed as is without copying
             
         Returns:
             bool: True if piece is valid, False otherwise
         """
         # If we don't have hashes to verify against, assume it's valid
-        if not self.piece_hashes or piece_index >= len(self.piece_hashes):
+        if piece_index >= self.hash_count:
             logging.warning(f"No hash available for piece {piece_index}, skipping verification")
             return True
             
-        # Calculate SHA-1 hash of the data
-        sha1 = hashlib.sha1(data).hexdigest()
-        
-        # Compare with expected hash
-        expected_hash = self.piece_hashes[piece_index]
-        is_valid = sha1 == expected_hash
+        # Calculate SHA-1 digest of the data and compare raw bytes with the expected slice
+        digest = hashlib.sha1(data).digest()
+        offset = piece_index * 20
+        expected_hash = self.piece_hashes[offset:offset + 20]
+        is_valid = digest == expected_hash
         
         if not is_valid:
-            logging.warning(f"Piece {piece_index} failed verification: got {sha1}, expected {expected_hash}")
+            logging.warning(f"Piece {piece_index} failed verification: got {digest.hex()}, expected {expected_hash.hex()}")
         
         return is_valid
     
     def receive_piece(self, piece_index, data):
         """
-        Process a received piece, verify it, and save it
+        Process a received piece: verify it and save it on the verify pool
+        
+        SHA-1 and the disk write run on a worker thread without holding self.lock, so the
+        reactor thread and other pieces are not blocked; the lock is only taken in
+        _finalize_piece to update the bookkeeping.
         
         Parameters:
             piece_index (int): Index of the piece
-            data (bytes): Piece data
+            data (bytes or memoryview): Piece data; copied once, so the caller may reuse its buffer
             
         Returns:
-            bool: True if piece was valid and saved, False otherwise
+            Future: Resolves to True if piece was valid and saved, False otherwise
         """
-        with self.lock:
-            # Validate piece size
-            if len(data) > self.piece_length:
-                logging.error(f"Received piece {piece_index} is too large")
-                return False
-                
-            # Verify piece hash
-            if not self.verify_piece(piece_index, data):
-                # If verification fails, remove from requested pieces so we can try again
-                self.requested_pieces.discard(piece_index)
-                return False
-            
-            # In multi-file torrents, pieces can span multiple files
-            # For simplicity, we'll save each piece to a temporary file first
-            piece_file = self.torrent_dir / f"piece_{piece_index}.tmp"
-            
-            try:
-                with open(piece_file, 'wb') as f:
-                    f.write(data)
-                
-                # Mark piece as downloaded
-                self.have_pieces[piece_index] = True
-                self.requested_pieces.discard(piece_index)
-                self.bytes_downloaded += len(data)
-                
-                # When all pieces are downloaded, assemble the files
-                if all(self.have_pieces):
-                    self._assemble_files()
-                
-                return True
-                
-            except Exception as e:
-                logging.error(f"Error saving piece {piece_index}: {e}")
-                return False
+        # Validate piece index and size
+        if not 0 <= piece_index < self.piece_count or len(data) > self.piece_length:
+            logging.error(f"Received piece {piece_index} is out of range or too large")
+            future = Future()
+            future.set_result(False)
+            return future
+        
+        if self.seed_mode:
+            # Đã có đủ dữ liệu: không ghi lại xuống đĩa piece mà peer gửi tới
+            future = Future()
+            future.set_result(True)
+            return future
+        
+        return self._verify_pool.submit(self._finalize_piece, piece_index, bytes(data))
     
-    def _assemble_files(self):
+    def _finalize_piece(self, piece_index, data):
         """
-        Assemble final files from pieces after all pieces are downloaded
+        Verify and store one received piece (runs on the verify pool)
+        
+        Parameters:
+            piece_index (int): Index of the piece
+            data (bytes): Piece data
+            
+        Returns:
+            bool: True if piece was valid and saved, False otherwise
         """
-        logging.info("Tất cả các mảnh đã tải xong, đang ghép file...")
+        # Verify piece hash (hashlib nhả GIL, nhiều piece được hash song song)
+        if not self.verify_piece(piece_index, data):
+            # If verification fails, remove from requested pieces so we can try again
+            with self.lock:
+                self._set_requested(piece_index, False)
+            return False
         
-        # Lặp qua từng file trong danh sách files
-        offset = 0  # Vị trí bắt đầu của file hiện tại trong toàn bộ dữ liệu
+        try:
+            # Ghi thẳng vào vị trí cuối cùng trong các file đích (piece có thể trải qua nhiều file),
+            # không qua file tạm và không cần ghép file khi tải xong. pwrite theo vị trí nên
+            # không cần lock giữa các piece khác nhau
+            self._write_range(piece_index * self.piece_length, data)
+        except Exception as e:
+            logging.error(f"Error saving piece {piece_index}: {e}")
+            with self.lock:
+                self._set_requested(piece_index, False)
+            return False
         
-        for file_info in self.files:
-            file_path = self.torrent_dir / file_info['path']
-            file_length = file_info['length']
-            
-            # Tạo thư mục chứa file nếu cần
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            
-            # Mở file đích để ghi dữ liệu
-            with open(file_path, 'wb') as output_file:
-                # Tính toán mảnh đầu tiên và cuối cùng chứa dữ liệu của file này
-                first_piece = offset // self.piece_length
-                last_piece = (offset + file_length - 1) // self.piece_length if file_length > 0 else first_piece
-                
-                # Vị trí bắt đầu trong mảnh đầu tiên
-                first_piece_offset = offset % self.piece_length
-                
-                # Lặp qua các mảnh cần thiết
-                for piece_index in range(first_piece, last_piece + 1):
-                    piece_file = self.torrent_dir / f"piece_{piece_index}.tmp"
-                    
-                    if piece_file.exists():
-                        with open(piece_file, 'rb') as piece_data:
-                            # Đối với mảnh đầu tiên, có thể cần bỏ qua một số byte đầu tiên
-                            if piece_index == first_piece and first_piece_offset > 0:
-                                piece_data.seek(first_piece_offset)
-                            
-                            # Đọc dữ liệu từ mảnh và ghi vào file đích
-                            data = piece_data.read()
-                            
-                            # Nếu là mảnh cuối cùng, chỉ ghi đến hết file
-                            if piece_index == last_piece:
-                                bytes_needed = (offset + file_length) - (piece_index * self.piece_length)
-                                if bytes_needed < len(data):
-                                    data = data[:bytes_needed]
-                            
-                            output_file.write(data)
-                    else:
-                        logging.error(f"Không tìm thấy mảnh {piece_index}")
+        with self.lock:
+            self._set_requested(piece_index, False)
+            if self._has(piece_index):
+                # Piece trùng (ví dụ do End Game), không đếm lại
+                return True
             
-            # Cập nhật offset cho file tiếp theo
-            offset += file_length
+            # Mark piece as downloaded
+            self._set_have(piece_index)
+            self._save_have(piece_index)
+            self.bytes_downloaded += len(data)
             
-            logging.info(f"Đã tạo file: {file_path}")
+            if self.is_complete:
+                # File rỗng không chứa piece nào, tạo nốt để đủ cấu trúc torrent
+                for file_index, file_info in enumerate(self.files):
+                    if file_info['length'] == 0:
+                        self._backing_fd(file_index)
+                logging.info("Tất cả các mảnh đã tải xong!")
         
-        # Xóa các file tạm
-        for i in range(self.piece_count):
-            piece_file = self.torrent_dir / f"piece_{i}.tmp"
-            if piece_file.exists():
-                try:
-                    os.unlink(piece_file)
-                except Exception as e:
-                    logging.error(f"Lỗi khi xóa file tạm: {e}")
-                    
-        logging.info("Hoàn tất ghép file!")
+        with self.progress_cv:
+            self.progress_cv.notify_all()
+        
+        return True
 
 
 class ConnectionManager:
@@ -314,6 +889,9 @@ class ConnectionManager:
         # Control flags
         self.running = False
         
+        # Đánh thức _connection_loop khi có peer mới hoặc khi dừng
+        self._wakeup = threading.Event()
+        
     def add_peer(self, peer_info):
         """
         Add a peer to connect to
@@ -347,8 +925,11 @@ class ConnectionManager:
                 'info': peer_info,
                 'handler': peer_handler,
                 'connected': False,
-                'last_seen': time.time()
+                'last_seen': time.monotonic()
             }
+            
+            # Kết nối ngay tới peer mới, không đợi hết chu kỳ của _connection_loop
+            self._wakeup.set()
     
     def start(self):
         """Start connection manager and connect to peers"""
@@ -378,6 +959,9 @@ class ConnectionManager:
             return
             
         self.running = False
+        self._wakeup.set()
+        with self.piece_manager.progress_cv:
+            self.piece_manager.progress_cv.notify_all()
         
         with self.lock:
             # Close all peer connections
@@ -414,7 +998,7 @@ class ConnectionManager:
                         
                         # Nếu đã thử quá nhiều lần, tạm thời bỏ qua peer này
                         if retry_counter[peer_id] >= 3:
-                            if time.time() - peer.get('last_retry', 0) < 60:  # Đợi 1 phút trước khi thử lại
+                            if time.monotonic() - peer.get('last_retry', 0) < 60:  # Đợi 1 phút trước khi thử lại
                                 continue
                             else:
                                 # Reset bộ đếm sau thời gian chờ
@@ -428,15 +1012,15 @@ class ConnectionManager:
                             logging.info(f"Đã kết nối thành công đến peer {peer_id}")
                         except ConnectionError as e:
                             retry_counter[peer_id] += 1
-                            peer['last_retry'] = time.time()
+                            peer['last_retry'] = time.monotonic()
                             logging.error(f"Lỗi kết nối đến peer {peer_id}: {e}")
                         except Exception as e:
                             retry_counter[peer_id] += 1
-                            peer['last_retry'] = time.time()
+                            peer['last_retry'] = time.monotonic()
                             logging.error(f"Lỗi không xác định khi kết nối đến peer {peer_id}: {e}")
                 
                 # Check for dead connections
-                now = time.time()
+                now = time.monotonic()
                 for peer_id, peer in list(self.peers.items()):
                     # Nếu kết nối đã được thiết lập nhưng đã lâu không có hoạt động
                     if peer['connected'] and peer['handler']:
@@ -452,14 +1036,16 @@ class ConnectionManager:
                     if peer['connected'] and peer['handler']:
                         peer['last_seen'] = peer['handler'].last_activity
             
-            # Sleep before next check
-            time.sleep(5)
+            # Chờ peer mới hoặc tối đa 5 giây trước lần kiểm tra tiếp theo
+            self._wakeup.wait(timeout=5)
+            self._wakeup.clear()
     
     def _start_server(self):
         """Start server socket to accept incoming connections"""
         try:
             server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            _tune_peer_socket(server_socket)
             server_socket.bind(('0.0.0.0', 6881))
             server_socket.listen(5)
             
@@ -469,6 +1055,7 @@ class ConnectionManager:
                 try:
                     # Accept new connections
                     client_socket, address = server_socket.accept()
+                    _tune_peer_socket(client_socket)
                     logging.info(f"Incoming connection from {address}")
                     
                     # Handle the connection in a new thread
@@ -537,12 +1124,9 @@ class ConnectionManager:
         while self.running:
             try:
                 # Chỉ kích hoạt end game khi tải xuống gần hoàn tất (>95%)
-                if self.piece_manager.progress > 0.95 and self.piece_manager.progress < 1.0:
+                if not self.piece_manager.is_complete and self.piece_manager.progress > 0.95:
                     # Tìm các mảnh còn thiếu
-                    missing_pieces = []
-                    for i in range(len(self.piece_manager.have_pieces)):
-                        if not self.piece_manager.have_pieces[i] and i not in self.piece_manager.requested_pieces:
-                            missing_pieces.append(i)
+                    missing_pieces = self.piece_manager.missing_pieces()
                     
                     if missing_pieces:
                         logging.info(f"End game strategy activated. Missing pieces: {len(missing_pieces)}")
@@ -552,44 +1136,36 @@ class ConnectionManager:
                             for peer_id, peer in self.peers.items():
                                 if peer['connected'] and peer['handler']:
                                     for piece_index in missing_pieces:
-                                        if peer['handler'].peer_bitfield[piece_index]:
+                                        if peer['handler'].peer_has(piece_index):
                                             # Thêm yêu cầu vào hàng đợi của peer này
                                             peer['handler'].request_piece(piece_index)
                 
             except Exception as e:
                 logging.error(f"Error in end game loop: {e}")
             
-            # Kiểm tra mỗi 5 giây
-            time.sleep(5)
+            # Chờ tới khi có piece mới (hoặc tối đa 5 giây) thay vì ngủ cố định
+            with self.piece_manager.progress_cv:
+                if self.running:
+                    self.piece_manager.progress_cv.wait(timeout=5)
     
     def _mddt_stats_loop(self):
         """
         Theo dõi và ghi log hiệu suất của MDDT (tải xuống nhiều mảnh từ nhiều nguồn)
+        
+        Tốc độ lấy từ EWMA mà mỗi PeerConnection cập nhật khi nhận dữ liệu, không cần
+        lấy mẫu - ngủ - lấy mẫu lại.
         """
         while self.running:
             try:
                 if len(self.peers) > 1:  # Chỉ có ý nghĩa khi có nhiều hơn 1 peer
-                    active_peers = 0
-                    total_download_speed = 0
-                    peer_speeds = {}
-                    
+                    now = time.monotonic()
                     with self.lock:
-                        for peer_id, peer in self.peers.items():
-                            if peer['connected'] and peer['handler']:
-                                active_peers += 1
-                                # Lưu trữ bytes đã tải xuống từ peer này
-                                peer_speeds[peer_id] = peer['handler'].bytes_downloaded
+                        handlers = [peer['handler'] for peer in self.peers.values()
+                                    if peer['connected'] and peer['handler']]
                     
+                    active_peers = len(handlers)
                     if active_peers > 1:
-                        # Tính toán tốc độ tải xuống
-                        time.sleep(1)  # Đợi 1 giây để có số liệu mới
-                        
-                        with self.lock:
-                            for peer_id, peer in self.peers.items():
-                                if peer_id in peer_speeds and peer['connected'] and peer['handler']:
-                                    # Tính bytes tải xuống trong 1 giây
-                                    new_bytes = peer['handler'].bytes_downloaded - peer_speeds[peer_id]
-                                    total_download_speed += new_bytes
+                        total_download_speed = sum(handler.download_rate(now) for handler in handlers)
                         
                         # Log hiệu suất MDDT
                         if total_download_speed > 0:
@@ -606,9 +1182,144 @@ class ConnectionManager:
             time.sleep(10)
 
 
+# Kích thước buffer nhận ban đầu của mỗi peer, đủ chứa nhiều block 16KB
+RX_BUFFER_SIZE = 1 << 17
+# Bố cục cố định của các trường trong message (big-endian), unpack_from đọc thẳng trong buffer
+_LEN = struct.Struct('>I')        # length prefix, HAVE
+_HDR = struct.Struct('>IB')       # <length><id>
+_PIECE = struct.Struct('>II')     # <index><begin> của PIECE
+_REQ = struct.Struct('>III')      # <index><begin><length> của REQUEST
+_REQUEST_MSG = struct.Struct('>IBIII')  # cả message REQUEST: <13><6><index><begin><length>
+
+# Peer không gửi dữ liệu quá số giây này thì coi tốc độ tải từ peer đó là 0
+RATE_IDLE_TIMEOUT = 5.0
+# Message lớn hơn mức này bị coi là lỗi giao thức (tránh cấp phát theo độ dài do peer gửi)
+MAX_MESSAGE_LENGTH = 1 << 25
+# Số thread gửi dùng chung cho mọi kết nối: ghi socket có thể chặn tới hết timeout nên không chạy trên reactor
+SEND_WORKERS = 8
+# Số block upload tối đa đang chờ gửi cho một peer; request vượt quá bị bỏ qua (peer sẽ request lại)
+MAX_PENDING_UPLOADS = 64
+
+
+class _PeerReactor:
+    """
+    One selector thread that serves every connected peer socket
+    
+    Incoming data is read when the socket is readable and split into messages, and
+    each connection's request queue is pumped on every tick. This replaces the two
+    threads (receiver + requester) that each PeerConnection used to start.
+    
+    The reactor never writes to a socket itself: outgoing messages are put on the
+    connection's outbox and written by the shared send pool, so a slow peer cannot
+    stall reads and request pumping for everyone else.
+    """
+    
+    # Chu kỳ tối đa giữa hai lần đẩy request (giống time.sleep(0.1) của _request_loop cũ)
+    TICK = 0.1
+    
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+        # Đăng ký/hủy được xếp hàng và áp dụng trong chính thread reactor,
+        # để không sửa selector trong lúc nó đang select()
+        self._pending = deque()
+        # Các lời gọi do thread khác gửi sang để chạy trên thread reactor (kết quả piece, End Game)
+        self._calls = deque()
+        self._thread = threading.Thread(target=self._run, name="peer-reactor", daemon=True)
+        self._thread.start()
+    
+    def register(self, conn):
+        """Start serving a connected PeerConnection"""
+        self._pending.append((True, conn))
+    
+    def unregister(self, conn):
+        """Stop serving a PeerConnection (its socket may already be closed)"""
+        self._pending.append((False, conn))
+    
+    def call_soon(self, fn, *args):
+        """Run fn(*args) on the reactor thread at the start of the next tick"""
+        self._calls.append((fn, args))
+    
+    def _run_calls(self):
+        while self._calls:
+            fn, args = self._calls.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"Error in reactor call {fn}: {e}")
+    
+    def _apply_pending(self):
+        while self._pending:
+            add, conn = self._pending.popleft()
+            if add:
+                if conn.connected and conn.socket and conn not in self.connections:
+                    self.selector.register(conn.socket, selectors.EVENT_READ, conn)
+                    self.connections.add(conn)
+            elif conn in self.connections:
+                self.connections.discard(conn)
+                try:
+                    self.selector.unregister(conn._registered_socket)
+                except (KeyError, ValueError):
+                    pass
+    
+    def _run(self):
+        while True:
+            try:
+                self._apply_pending()
+                self._run_calls()
+                if self.connections:
+                    events = self.selector.select(self.TICK)
+                else:
+                    # SelectSelector trên Windows không chấp nhận danh sách fd rỗng
+                    time.sleep(self.TICK)
+                    events = ()
+                
+                for key, _ in events:
+                    key.data._on_readable()
+                
+                # Đọc đồng hồ một lần cho cả tick
+                now = time.monotonic()
+                for conn in list(self.connections):
+                    conn._pump_requests(now)
+            except Exception as e:
+                logging.error(f"Error in peer reactor: {e}")
+
+
+_reactor = None
+_reactor_lock = threading.Lock()
+_send_pool = None
+
+
+def _get_reactor():
+    """Return the shared peer reactor, starting it on first use"""
+    global _reactor
+    if _reactor is None:
+        with _reactor_lock:
+            if _reactor is None:
+                _reactor = _PeerReactor()
+    return _reactor
+
+
+def _get_send_pool():
+    """Return the thread pool that writes to peer sockets, starting it on first use"""
+    global _send_pool
+    if _send_pool is None:
+        with _reactor_lock:
+            if _send_pool is None:
+                _send_pool = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix="peer-send")
+    return _send_pool
+
+
 class PeerConnection:
     """Handles communication with a single peer"""
     
+    # Phần đầu cố định của handshake: <pstrlen><pstr><reserved>
+    HANDSHAKE_PREFIX = bytes([19]) + b"BitTorrent protocol" + b"\x00" * 8
+    
+    # Các message không có payload, dựng sẵn một lần thay vì ghép bytes mỗi lần gửi
+    _KEEP_ALIVE_MSG = b"\x00\x00\x00\x00"
+    _BARE_MESSAGES = {msg_id: b"\x00\x00\x00\x01" + bytes([msg_id]) for msg_id in (0, 1, 2, 3)}
+    
     def __init__(self, peer_info, info_hash, piece_manager, our_peer_id):
         """
         Initialize peer connection
@@ -628,29 +1339,63 @@ class PeerConnection:
         self.port = peer_info.get('port')
         self.peer_id = peer_info.get('peer_id')
         
+        # Dạng bytes của info_hash/peer_id và handshake không đổi theo kết nối, tính một lần
+        self._info_hash_bytes = bytes.fromhex(info_hash) if isinstance(info_hash, str) else bytes(info_hash)
+        self._our_peer_id_bytes = our_peer_id.encode() if isinstance(our_peer_id, str) else bytes(our_peer_id)
+        self._handshake_msg = self.HANDSHAKE_PREFIX + self._info_hash_bytes + self._our_peer_id_bytes
+        
         self.socket = None
+        # Socket đã đăng ký với reactor (self.socket bị đặt None khi close)
+        self._registered_socket = None
+        # Buffer nhận cấp phát sẵn: recv_into ghi thẳng vào đây, message được xử lý qua memoryview.
+        # _rx_len là số byte đang giữ (phần đầu của message chưa nhận đủ)
+        self._rx_buf = bytearray(RX_BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx_buf)
+        self._rx_len = 0
         self.connected = False
         self.peer_choking = True  # Mặc định ban đầu là bị chặn
         self.am_choking = True    # Mặc định ban đầu là ta chặn peer
         self.peer_interested = False
         self.am_interested = False
         
-        # For tracking peer's available pieces
-        self.peer_bitfield = [False] * piece_manager.piece_count
+        # For tracking peer's available pieces: bitfield đóng gói cùng định dạng với PieceManager.have_pieces
+        self.peer_bitfield = bytearray((piece_manager.piece_count + 7) // 8)
+        # Số piece peer đang có, cập nhật cùng lúc với peer_bitfield để không phải đếm lại khi lấy thống kê
+        self.peer_piece_count = 0
         
         # Request queue for sending piece requests to peer
         self.request_queue = deque()
+        # Piece đã nhận xong: các request còn trong hàng đợi của chúng bị bỏ qua khi lấy ra,
+        # thay vì dựng lại cả deque mỗi khi một piece hoàn tất
+        self.cancelled_pieces = set()
         
         # Statistics for this connection
         self.bytes_downloaded = 0
         self.bytes_uploaded = 0
-        self.last_activity = time.time()
+        # Tốc độ tải trung bình trượt (EWMA, byte/giây), cập nhật mỗi khi nhận block
+        self.ewma_bps = 0.0
+        self.last_sample_time = time.monotonic()
+        # Dùng đồng hồ monotonic: khoảng thời gian không bị âm/nhảy khi đồng hồ hệ thống thay đổi
+        self.last_activity = time.monotonic()
         
         # Maximum number of outstanding requests
         self.max_requests = 10  # Tăng số lượng request đồng thời để cải thiện MDDT
         
-        # For thread safety
+        # For thread safety: lock bảo vệ trạng thái kết nối (close), _send_lock bảo vệ hàng đợi gửi.
+        # request_queue và cancelled_pieces không cần lock: chỉ thread reactor đọc/ghi chúng.
+        # Kết quả kiểm tra piece (từ verify pool) và request End Game được chuyển về reactor
+        # qua _PeerReactor.call_soon
         self.lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        # Hàng đợi gửi: (buffers, file_spans, upload_bytes), được một thread của send pool ghi lần lượt.
+        # _sending: đang có thread ghi hàng đợi này; _pending_uploads: số block upload còn trong hàng đợi
+        self._outbox = deque()
+        self._sending = False
+        self._pending_uploads = 0
+
+    def peer_has(self, piece_index):
+        """Return True if the peer advertised the piece in BITFIELD or HAVE"""
+        return bool(self.peer_bitfield[piece_index >> 3] & (0x80 >> (piece_index & 7)))
 
     def connect(self):
         """Connect to the peer and perform handshake"""
@@ -659,24 +1404,30 @@ class PeerConnection:
         
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            _tune_peer_socket(self.socket)
             self.socket.settimeout(10)  # 10 second timeout
             logging.info(f"Connecting to peer {self.peer_id} at {self.ip}:{self.port}")
             self.socket.connect((self.ip, self.port))
             
             # Perform the BitTorrent protocol handshake
             resp_peer_id = self._perform_handshake()
-            if resp_peer_id != self.peer_id:
+            # Peer lấy từ danh sách compact không có peer_id thật (chỉ "ip:port") để so sánh
+            if resp_peer_id != self.peer_id and not self.peer_info.get('compact'):
                 logging.warning(f"Peer responded with different peer_id: {resp_peer_id} vs {self.peer_id}")
                 
             self.connected = True
-            self.last_activity = time.time()
+            self.last_activity = time.monotonic()
+            
+            # Báo các piece đã có ngay sau handshake, để peer có thể request từ chúng ta
+            if self.piece_manager.have_count:
+                self._send_message(5, self.piece_manager.bitfield_bytes())
             
             # Send interested message to peer
             self._send_interested()
             
-            # Start communication threads
-            threading.Thread(target=self._receiver_loop, daemon=True).start()
-            threading.Thread(target=self._request_loop, daemon=True).start()
+            # Nhận dữ liệu và gửi request do reactor chung đảm nhận, không tạo thread riêng cho mỗi peer
+            self._registered_socket = self.socket
+            _get_reactor().register(self)
             
             return True
             
@@ -687,22 +1438,8 @@ class PeerConnection:
     
     def _perform_handshake(self):
         """Perform the BitTorrent protocol handshake with the peer"""
-        # Handshake: <pstrlen><pstr><reserved><info_hash><peer_id>
-        pstr = "BitTorrent protocol"
-        reserved = b'\x00' * 8
-        
-        # Chuyển đổi info_hash từ hex string sang bytes nếu cần
-        info_hash_bytes = bytes.fromhex(self.info_hash) if isinstance(self.info_hash, str) else self.info_hash
-        
-        # Chuyển đổi peer_id sang bytes nếu cần
-        peer_id_bytes = self.our_peer_id.encode() if isinstance(self.our_peer_id, str) else self.our_peer_id
-        
-        # Construct handshake message
-        handshake = bytes([len(pstr)]) + \
-                    pstr.encode() + \
-                    reserved + \
-                    info_hash_bytes + \
-                    peer_id_bytes
+        # Handshake: <pstrlen><pstr><reserved><info_hash><peer_id>, dựng sẵn trong __init__
+        handshake = self._handshake_msg
                     
         logging.debug(f"Sending handshake to {self.ip}:{self.port}")
         # Send handshake
@@ -717,9 +1454,8 @@ class PeerConnection:
             logging.debug(f"Received handshake from {self.ip}:{self.port}")
                 
             # Validate response contains correct info_hash
-            resp_info_hash = response[28:48].hex()
-            if resp_info_hash != (self.info_hash if isinstance(self.info_hash, str) else self.info_hash.hex()):
-                raise ValueError(f"Peer responded with wrong info_hash: {resp_info_hash}")
+            if response[28:48] != self._info_hash_bytes:
+                raise ValueError(f"Peer responded with wrong info_hash: {response[28:48].hex()}")
                 
             # Extract peer_id from response
             resp_peer_id = response[48:68]
@@ -744,143 +1480,237 @@ class PeerConnection:
                 except:
                     pass
                 self.socket = None
+            
+            if self._registered_socket is not None:
+                _get_reactor().unregister(self)
+            
+            # Peer ngắt kết nối thì các piece của nó không còn tải được nữa
+            if any(self.peer_bitfield):
+                self.piece_manager.remove_availability(self.peer_bitfield)
+                self.peer_bitfield = bytearray(len(self.peer_bitfield))
 
-    def _receiver_loop(self):
-        """Handle incoming messages from peer"""
-        logging.info(f"Starting receiver loop for peer {self.peer_id}")
-        while self.connected:
+    def _on_readable(self):
+        """Read what the socket has and handle every complete message (called by the reactor)"""
+        held = self._rx_len
+        try:
+            received = self.socket.recv_into(self._rx_view[held:]) if self.socket else 0
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        except Exception as e:
+            logging.error(f"Error reading from socket ({self.peer_id}): {e}")
+            received = 0
+        
+        if not received:
+            logging.warning("Connection closed by peer")
+            self.close()
+            return
+        
+        # Một lần đọc đồng hồ cho mọi message trong lần recv này
+        self.last_activity = time.monotonic()
+        
+        if _TCP_QUICKACK is not None:
+            # ACK ngay các block vừa nhận thay vì chờ delayed ACK, để peer gửi tiếp không bị chặn
             try:
-                # Read message length (4 bytes big-endian)
-                len_bytes = self._read_exactly(4)
-                if not len_bytes:
-                    logging.warning("Connection closed by peer")
+                self.socket.setsockopt(socket.IPPROTO_TCP, _TCP_QUICKACK, 1)
+            except OSError:
+                pass
+        
+        buf = self._rx_buf
+        view = self._rx_view
+        available = held + received
+        
+        # Xử lý các message hoàn chỉnh ngay trong buffer: <length 4 bytes big-endian><id><payload>.
+        # Payload là memoryview trỏ vào buffer, chỉ dùng được trong lúc xử lý message
+        pos = 0
+        try:
+            while available - pos >= 4:
+                msg_length, = _LEN.unpack_from(buf, pos)
+                end = pos + 4 + msg_length
+                if end > available:
+                    if 4 + msg_length > len(buf):
+                        if msg_length > MAX_MESSAGE_LENGTH:
+                            raise ValueError(f"message too large ({msg_length} bytes)")
+                        self._grow_rx_buffer(4 + msg_length, pos, available)
+                        buf, view = self._rx_buf, self._rx_view
+                        available -= pos
+                        pos = 0
                     break
-                    
-                msg_length = int.from_bytes(len_bytes, byteorder='big')
                 
                 # Keep-alive message
                 if msg_length == 0:
                     logging.debug("Received keep-alive message")
-                    self.last_activity = time.time()
-                    continue
-                    
-                # Read message ID and payload
-                msg_id_bytes = self._read_exactly(1)
-                if not msg_id_bytes:
-                    break
-                    
-                msg_id = msg_id_bytes[0]
-                payload = self._read_exactly(msg_length - 1) if msg_length > 1 else b''
+                else:
+                    self._handle_message(buf[pos + 4], view[pos + 5:end])
+                pos = end
                 
-                # Update last activity time
-                self.last_activity = time.time()
-                
-                # Process different message types
-                if msg_id == 0:  # choke
-                    logging.debug(f"Peer {self.peer_id} choked us")
-                    self.peer_choking = True
-                elif msg_id == 1:  # unchoke
-                    logging.debug(f"Peer {self.peer_id} unchoked us")
-                    self.peer_choking = False
-                elif msg_id == 2:  # interested
-                    logging.debug(f"Peer {self.peer_id} is interested")
-                    self.peer_interested = True
-                    # Since peer is interested, we should unchoke them to allow uploads
-                    if self.am_choking:
-                        self._send_unchoke()
-                elif msg_id == 3:  # not interested
-                    logging.debug(f"Peer {self.peer_id} is not interested")
-                    self.peer_interested = False
-                elif msg_id == 4:  # have
-                    piece_index = int.from_bytes(payload, byteorder='big')
-                    logging.debug(f"Peer {self.peer_id} has piece {piece_index}")
-                    self.peer_bitfield[piece_index] = True
-                    # If we need this piece, express interest
-                    if not self.piece_manager.have_pieces[piece_index]:
-                        if not self.am_interested:
-                            self._send_interested()
-                elif msg_id == 5:  # bitfield
-                    logging.debug(f"Received bitfield from peer {self.peer_id}")
-                    self._process_bitfield(payload)
-                    # Check if peer has pieces we need
-                    for i, has_piece in enumerate(self.peer_bitfield):
-                        if has_piece and not self.piece_manager.have_pieces[i]:
-                            if not self.am_interested:
-                                self._send_interested()
-                            break
-                elif msg_id == 6:  # request
-                    logging.debug(f"Received request from peer {self.peer_id}")
-                    self._process_request(payload)
-                elif msg_id == 7:  # piece
-                    # Extract piece info: <index><begin><block>
-                    if len(payload) < 8:
-                        continue
-                    
-                    index = int.from_bytes(payload[0:4], byteorder='big')
-                    begin = int.from_bytes(payload[4:8], byteorder='big')
-                    block = payload[8:]
-                    
-                    logging.debug(f"Received piece {index} ({len(block)} bytes) from peer {self.peer_id}")
-                    
-                    # Update download statistics
-                    self.bytes_downloaded += len(block)
-                    
-                    # Process the piece data
-                    result = self.piece_manager.receive_piece(index, block)
-                    if result:
-                        logging.info(f"Successfully received piece {index} from peer {self.peer_id}")
-                        
-                        # Send have message to all peers
-                        # (In a full implementation, this would be done by the ConnectionManager)
-                        
-                        # Since we've got a piece, update our requests
-                        with self.lock:
-                            # Remove any requests for this piece from the queue
-                            self.request_queue = deque([r for r in self.request_queue if r[0] != index])
-                    else:
-                        logging.warning(f"Failed to process piece {index} from peer {self.peer_id}")
-                
-                # Gửi keep-alive message mỗi 2 phút nếu không có hoạt động nào
-                if time.time() - self.last_activity > 120:
-                    self._send_keep_alive()
-                
-            except Exception as e:
-                logging.error(f"Error in receiver loop with peer {self.peer_id}: {e}")
-                break
-                
-        self.close()
+                if not self.connected:
+                    return
+        except Exception as e:
+            logging.error(f"Error in receiver loop with peer {self.peer_id}: {e}")
+            self.close()
+            return
+        
+        # Dời phần message còn dở về đầu buffer
+        remaining = available - pos
+        if pos and remaining:
+            buf[:remaining] = bytes(view[pos:available])
+        self._rx_len = remaining
+    
+    def _grow_rx_buffer(self, size, start, end):
+        """Replace the receive buffer with a larger one, keeping bytes [start, end)"""
+        new_buf = bytearray(max(size, 2 * len(self._rx_buf)))
+        new_buf[:end - start] = self._rx_view[start:end]
+        self._rx_view.release()
+        self._rx_buf = new_buf
+        self._rx_view = memoryview(new_buf)
+    
+    def _handle_message(self, msg_id, payload):
+        """
+        Handle one message received from the peer
+        
+        Parameters:
+            msg_id (int): Message ID
+            payload (memoryview): Message payload, valid only until this call returns
+        """
+        # Process different message types
+        if msg_id == 0:  # choke
+            logging.debug(f"Peer {self.peer_id} choked us")
+            self.peer_choking = True
+        elif msg_id == 1:  # unchoke
+            logging.debug(f"Peer {self.peer_id} unchoked us")
+            self.peer_choking = False
+        elif msg_id == 2:  # interested
+            logging.debug(f"Peer {self.peer_id} is interested")
+            self.peer_interested = True
+            # Since peer is interested, we should unchoke them to allow uploads
+            if self.am_choking:
+                self._send_unchoke()
+        elif msg_id == 3:  # not interested
+            logging.debug(f"Peer {self.peer_id} is not interested")
+            self.peer_interested = False
+        elif msg_id == 4:  # have
+            if len(payload) < 4:
+                return
+            piece_index, = _LEN.unpack_from(payload)
+            logging.debug(f"Peer {self.peer_id} has piece {piece_index}")
+            if 0 <= piece_index < self.piece_manager.piece_count and not self.peer_has(piece_index):
+                self.peer_bitfield[piece_index >> 3] |= 0x80 >> (piece_index & 7)
+                self.peer_piece_count += 1
+                self.piece_manager.add_availability((piece_index,))
+            # If we need this piece, express interest
+            if not self.piece_manager.has_piece(piece_index):
+                if not self.am_interested:
+                    self._send_interested()
+        elif msg_id == 5:  # bitfield
+            logging.debug(f"Received bitfield from peer {self.peer_id}")
+            self._process_bitfield(payload)
+            # Check if peer has pieces we need
+            if self.piece_manager.needed_mask(self.peer_bitfield) and not self.am_interested:
+                self._send_interested()
+        elif msg_id == 6:  # request
+            logging.debug(f"Received request from peer {self.peer_id}")
+            self._process_request(payload)
+        elif msg_id == 7:  # piece
+            # Extract piece info: <index><begin><block>
+            if len(payload) < 8:
+                return
+            
+            index, begin = _PIECE.unpack_from(payload)
+            # memoryview: không copy phần dữ liệu khối khi cắt payload
+            block = payload[8:]
+            
+            logging.debug(f"Received piece {index} ({len(block)} bytes) from peer {self.peer_id}")
+            
+            # Update download statistics
+            self.bytes_downloaded += len(block)
+            # last_activity là thời điểm của lần recv chứa block này
+            self._update_rate(len(block), self.last_activity)
+            
+            # Process the piece data: kiểm tra và ghi chạy trên pool, kết quả được xử lý trên reactor
+            future = self.piece_manager.receive_piece(index, block)
+            future.add_done_callback(
+                lambda f, index=index: _get_reactor().call_soon(self._on_piece_done, index, f))
+    
+    def _update_rate(self, nbytes, now):
+        """Fold a received block, received at time.monotonic() value now, into the EWMA download rate"""
+        elapsed = max(now - self.last_sample_time, 1e-3)
+        self.ewma_bps = 0.9 * self.ewma_bps + 0.1 * (nbytes / elapsed)
+        self.last_sample_time = now
+        self.piece_manager.record_transfer(nbytes, now=now)
+    
+    def download_rate(self, now=None):
+        """
+        Current download rate from this peer
+        
+        Parameters:
+            now (float): time.monotonic() value, read once by callers iterating many peers
+            
+        Returns:
+            float: EWMA rate in bytes/second, 0 if nothing arrived for RATE_IDLE_TIMEOUT seconds
+        """
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_sample_time > RATE_IDLE_TIMEOUT:
+            return 0.0
+        return self.ewma_bps
+    
+    def _on_piece_done(self, index, future):
+        """
+        Handle the outcome of a piece handed to PieceManager.receive_piece (runs on the reactor)
+        
+        Parameters:
+            index (int): Index of the piece
+            future (Future): Result of receive_piece
+        """
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error(f"Error processing piece {index} from peer {self.peer_id}: {e}")
+            result = False
+        
+        if result:
+            logging.info(f"Successfully received piece {index} from peer {self.peer_id}")
+            
+            # Send have message to all peers
+            # (In a full implementation, this would be done by the ConnectionManager)
+            
+            # Since we've got a piece, update our requests: các request còn lại của piece này
+            # sẽ bị bỏ qua trong _pump_requests
+            self.cancelled_pieces.add(index)
+        else:
+            logging.warning(f"Failed to process piece {index} from peer {self.peer_id}")
 
     def _read_exactly(self, n):
         """Read exactly n bytes from socket"""
         if n <= 0:
             return b''
-            
-        data = b''
-        while len(data) < n:
+        
+        # recv_into ghi thẳng vào một buffer, không tạo bytes mới cho mỗi gói rồi nối lại
+        data = bytearray(n)
+        view = memoryview(data)
+        pos = 0
+        retried = False
+        self.socket.settimeout(10)  # Đặt timeout là 10 giây
+        while pos < n:
             try:
-                self.socket.settimeout(10)  # Đặt timeout là 10 giây
-                packet = self.socket.recv(n - len(data))
+                received = self.socket.recv_into(view[pos:])
                 
-                if not packet:  # Kết nối đã đóng
+                if not received:  # Kết nối đã đóng
                     logging.warning(f"Connection to {self.peer_id} closed when reading data")
                     return None
                     
-                data += packet
+                pos += received
+                if retried:
+                    retried = False
+                    self.socket.settimeout(10)
                 
             except socket.timeout:
-                # Xử lý timeout - có thể thử lại một lần nữa
-                logging.warning(f"Socket timeout when reading from {self.peer_id}, retrying...")
-                try:
-                    # Thử lại thêm một lần với timeout dài hơn
-                    self.socket.settimeout(15)
-                    packet = self.socket.recv(n - len(data))
-                    if packet:
-                        data += packet
-                    else:
-                        return None
-                except Exception:
-                    # Nếu vẫn thất bại, đầu hàng
+                # Xử lý timeout - thử lại thêm một lần với timeout dài hơn, nếu vẫn thất bại thì đầu hàng
+                if retried:
                     return None
+                logging.warning(f"Socket timeout when reading from {self.peer_id}, retrying...")
+                retried = True
+                self.socket.settimeout(15)
                     
             except ConnectionResetError:
                 logging.error(f"Connection reset by peer {self.peer_id}")
@@ -889,48 +1719,55 @@ class PeerConnection:
             except Exception as e:
                 logging.error(f"Error reading from socket ({self.peer_id}): {e}")
                 return None
-                
-        return data
-
-    def _request_loop(self):
-        """Request pieces from peer"""
-        logging.info(f"Starting request loop for peer {self.peer_id}")
         
-        while self.connected:
-            try:
-                # Don't request if peer is choking us
-                if self.peer_choking:
-                    time.sleep(1)
-                    continue
+        return bytes(data)
 
-                # If our request queue is empty, fill it with new pieces to request
-                with self.lock:
-                    if len(self.request_queue) < self.max_requests:
-                        self._fill_request_queue()
-                    
-                    # If still empty after filling, sleep and try again later
-                    if not self.request_queue:
-                        time.sleep(1)
-                        continue
-                
-                    # Send requests for multiple blocks at once (MDDT optimization)
-                    # Gửi nhiều request cùng một lúc để tối ưu MDDT
-                    requests_to_send = min(self.max_requests - len(self.request_queue) + 1, 
-                                          len(self.request_queue))
-                    
-                    for _ in range(requests_to_send):
-                        if self.request_queue:
-                            piece_index, begin, length = self.request_queue.popleft()
-                            self._send_request(piece_index, begin, length)
-                
-                # Wait a bit before next request batch to avoid flooding
-                time.sleep(0.1)  # Shorter delay to increase throughput
-                
-            except Exception as e:
-                logging.error(f"Error in request loop with peer {self.peer_id}: {e}")
-                break
+    def _pump_requests(self, now):
+        """
+        Request pieces from peer (called by the reactor on every tick)
         
-        self.close()
+        Parameters:
+            now (float): time.monotonic() value of the current tick
+        """
+        if not self.connected:
+            return
+        
+        try:
+            # Gửi keep-alive message mỗi 2 phút nếu không có hoạt động nào
+            if now - self.last_activity > 120:
+                self._send_keep_alive()
+            
+            # Don't request if peer is choking us
+            if self.peer_choking:
+                return
+            
+            # If our request queue is empty, fill it with new pieces to request
+            if len(self.request_queue) < self.max_requests:
+                self._fill_request_queue()
+            
+            # Send requests for multiple blocks at once (MDDT optimization)
+            # Gửi nhiều request cùng một lúc để tối ưu MDDT
+            requests_to_send = min(self.max_requests - len(self.request_queue) + 1, 
+                                  len(self.request_queue))
+            queue = self.request_queue
+            cancelled = self.cancelled_pieces
+            batch = []
+            while queue and len(batch) < requests_to_send:
+                request = queue.popleft()
+                if request[0] not in cancelled:
+                    batch.append(request)
+            
+            # Hàng đợi rỗng thì không còn request nào tham chiếu tới các piece đã hủy
+            if not queue and cancelled:
+                cancelled.clear()
+            
+            # Cả lô request đi trong một lần ghi thay vì một syscall cho mỗi request
+            if batch:
+                self._send_requests(batch)
+            
+        except Exception as e:
+            logging.error(f"Error in request loop with peer {self.peer_id}: {e}")
+            self.close()
     
     def _fill_request_queue(self):
         """Fill the request queue with blocks to download"""
@@ -961,26 +1798,25 @@ class PeerConnection:
 
     def _process_bitfield(self, payload):
         """Process a bitfield message from peer"""
-        piece_count = len(self.peer_bitfield)
+        piece_count = self.piece_manager.piece_count
         expected_length = (piece_count + 7) // 8  # Ceiling division
         
         if len(payload) < expected_length:
             logging.warning(f"Received invalid bitfield length: got {len(payload)}, expected {expected_length}")
             return
         
-        # Each bit in the bitfield represents a piece
-        for i in range(piece_count):
-            byte_index = i // 8
-            if byte_index >= len(payload):
-                break
-                
-            bit_index = 7 - (i % 8)  # Bits are sent in big-endian order
-            has_piece = (payload[byte_index] >> bit_index) & 1
-            
-            if has_piece:
-                self.peer_bitfield[i] = True
-        
-        logging.debug(f"Peer {self.peer_id} has {sum(self.peer_bitfield)} pieces")
+        # Payload đã cùng định dạng (bit cao nhất là piece 0): OR thẳng vào bitfield,
+        # xóa các bit thừa ở byte cuối để không thành piece không tồn tại
+        current = int.from_bytes(self.peer_bitfield, 'big')
+        merged = current | int.from_bytes(payload[:expected_length], 'big')
+        spare_bits = expected_length * 8 - piece_count
+        merged &= ~((1 << spare_bits) - 1)
+        self.peer_bitfield[:] = merged.to_bytes(expected_length, 'big')
+        # Chỉ cộng availability cho các piece mới thấy lần này
+        self.piece_manager.add_availability(_bit_indexes(merged & ~current, expected_length))
+        
+        self.peer_piece_count = merged.bit_count()
+        logging.debug(f"Peer {self.peer_id} has {self.peer_piece_count} pieces")
     
     def _process_request(self, payload):
         """Process a request message from a peer"""
@@ -994,73 +1830,123 @@ class PeerConnection:
             logging.warning("Invalid request message size")
             return
             
-        piece_index = int.from_bytes(payload[0:4], byteorder='big')
-        begin = int.from_bytes(payload[4:8], byteorder='big')
-        length = int.from_bytes(payload[8:12], byteorder='big')
+        piece_index, begin, length = _REQ.unpack_from(payload)
         
         # Check if we have the requested piece
-        if piece_index >= len(self.piece_manager.have_pieces) or not self.piece_manager.have_pieces[piece_index]:
+        if not self.piece_manager.has_piece(piece_index):
             logging.warning(f"Peer {self.peer_id} requested piece {piece_index} which we don't have")
             return
+        
+        # Peer không nhận kịp: bỏ qua request thay vì để hàng đợi gửi lớn mãi
+        if self._pending_uploads >= MAX_PENDING_UPLOADS:
+            logging.debug(f"Dropping request from {self.peer_id}: {self._pending_uploads} blocks already queued")
+            return
             
-        # Read the piece data from our storage
+        # Read the piece data from our storage. Block chỉ được xếp vào hàng đợi gửi,
+        # việc chép dữ liệu và ghi socket diễn ra trên send pool, không chặn reactor
         try:
-            # In a real implementation, read from the actual file
-            # For simplicity, we'll just read from the piece file
-            piece_file = self.piece_manager.torrent_dir / f"piece_{piece_index}.tmp"
+            header = _HDR.pack(9 + length, 7) + _PIECE.pack(piece_index, begin)  # 7 = piece
+            if not self.piece_manager.seed_mode:
+                # Kernel chép thẳng từ page cache của file đích sang socket, không qua bytes Python.
+                # Ở seed mode read_block trả về view của mmap nên đi đường sendmsg
+                spans = self.piece_manager.block_file_spans(piece_index, begin, length)
+                if spans is None:
+                    logging.warning(f"Could not read block {begin}+{length} of piece {piece_index}")
+                    return
+                buffers = [header]
+            else:
+                # Đọc trực tiếp từ các file đích
+                data = self.piece_manager.read_block(piece_index, begin, length)
+                if data is None or len(data) != length:
+                    logging.warning(f"Could not read block {begin}+{length} of piece {piece_index}")
+                    return
+                buffers = [header, data]
+                spans = ()
             
-            if not piece_file.exists():
-                logging.warning(f"Piece file not found: {piece_file}")
-                return
-                
-            with open(piece_file, 'rb') as f:
-                f.seek(begin)
-                data = f.read(length)
-                
-            if len(data) != length:
-                logging.warning(f"Could not read full block: got {len(data)}, expected {length}")
-                return
-                
-            # Send the piece data to the peer
-            self._send_piece(piece_index, begin, data)
-            self.bytes_uploaded += len(data)
-            self.piece_manager.bytes_uploaded += len(data)
+            # Send the piece data to the peer; thống kê upload được cộng khi đã gửi xong
+            logging.debug(f"Sending piece {piece_index}, offset {begin}, length {length} to {self.peer_id}")
+            self._send_raw(buffers, spans, upload_bytes=length)
             
         except Exception as e:
             logging.error(f"Error processing request for piece {piece_index}: {e}")
 
-    def _send_message(self, msg_id, payload=b''):
-        """Send a BitTorrent protocol message"""
-        with self.lock:
+    def _send_message(self, msg_id, *payload_parts):
+        """
+        Send a BitTorrent protocol message
+        
+        Parameters:
+            msg_id (int): Message ID
+            *payload_parts (bytes-like): Payload pieces, sent with scatter-gather without joining them
+        """
+        # Message format: <length prefix><message ID><payload>
+        if payload_parts:
+            payload_length = sum(len(part) for part in payload_parts)
+            buffers = [_HDR.pack(payload_length + 1, msg_id), *payload_parts]  # +1 for message ID
+        else:
+            buffers = [self._BARE_MESSAGES.get(msg_id) or _HDR.pack(1, msg_id)]
+        return self._send_raw(buffers)
+    
+    def _send_raw(self, buffers, file_spans=(), upload_bytes=0):
+        """
+        Queue already framed bytes for sending; never blocks on the socket
+        
+        Parameters:
+            buffers (list): bytes-like objects forming one or more complete messages
+            file_spans (list): (fd, offset, count) ranges sent with sendfile right after buffers,
+                as the tail of the last message
+            upload_bytes (int): Size of the uploaded block carried by this message, counted once sent
+            
+        Returns:
+            bool: True if the message was queued, False if the connection is closed
+        """
+        with self._send_lock:
             if not self.connected or not self.socket:
                 return False
-                
-            # Message format: <length prefix><message ID><payload>
-            msg_length = len(payload) + 1  # +1 for message ID
-            msg = msg_length.to_bytes(4, byteorder='big') + bytes([msg_id]) + payload
+            self._outbox.append((buffers, file_spans, upload_bytes))
+            if upload_bytes:
+                self._pending_uploads += 1
+            if self._sending:
+                return True
+            self._sending = True
+        
+        _get_send_pool().submit(self._drain_outbox)
+        return True
+    
+    def _drain_outbox(self):
+        """Write queued messages in order until the outbox is empty (runs on the send pool)"""
+        while True:
+            with self._send_lock:
+                sock = self.socket
+                if not self._outbox or not self.connected or not sock:
+                    self._outbox.clear()
+                    self._pending_uploads = 0
+                    self._sending = False
+                    return
+                buffers, file_spans, upload_bytes = self._outbox.popleft()
             
             try:
-                self.socket.sendall(msg)
-                self.last_activity = time.time()
-                return True
+                _send_buffers(sock, buffers)
+                for fd, offset, count in file_spans:
+                    sock.sendfile(_DescriptorFile(fd), offset, count)
             except Exception as e:
                 logging.error(f"Error sending message to {self.peer_id}: {e}")
+                with self._send_lock:
+                    self._outbox.clear()
+                    self._pending_uploads = 0
+                    self._sending = False
                 self.close()
-                return False
+                return
+            
+            self.last_activity = time.monotonic()
+            if upload_bytes:
+                with self._send_lock:
+                    self._pending_uploads -= 1
+                self.bytes_uploaded += upload_bytes
+                self.piece_manager.record_upload(upload_bytes)
 
     def _send_keep_alive(self):
         """Send a keep-alive message (zero-length message)"""
-        if not self.connected or not self.socket:
-            return False
-            
-        try:
-            self.socket.sendall((0).to_bytes(4, byteorder='big'))
-            self.last_activity = time.time()
-            return True
-        except Exception as e:
-            logging.error(f"Error sending keep-alive to {self.peer_id}: {e}")
-            self.close()
-            return False
+        return self._send_raw([self._KEEP_ALIVE_MSG])
 
     def _send_interested(self):
         """Send an interested message to the peer"""
@@ -1097,24 +1983,28 @@ class PeerConnection:
     def _send_have(self, piece_index):
         """Send a have message to the peer"""
         logging.debug(f"Sending have message for piece {piece_index} to {self.peer_id}")
-        payload = piece_index.to_bytes(4, byteorder='big')
-        return self._send_message(4, payload)  # 4 = have
+        return self._send_message(4, _LEN.pack(piece_index))  # 4 = have
         
     def _send_request(self, piece_index, begin, length):
         """Send a request for a piece block"""
         logging.debug(f"Requesting piece {piece_index}, offset {begin}, length {length} from {self.peer_id}")
-        payload = piece_index.to_bytes(4, byteorder='big') + \
-                begin.to_bytes(4, byteorder='big') + \
-                length.to_bytes(4, byteorder='big')
-        return self._send_message(6, payload)  # 6 = request
+        return self._send_message(6, _REQ.pack(piece_index, begin, length))  # 6 = request
+        
+    def _send_requests(self, requests):
+        """
+        Send several block requests as a single write
+        
+        Parameters:
+            requests (list): (piece_index, begin, length) tuples
+        """
+        logging.debug(f"Requesting {len(requests)} blocks from {self.peer_id}")
+        pack = _REQUEST_MSG.pack
+        return self._send_raw([b"".join(pack(13, 6, *request) for request in requests)])
         
     def _send_piece(self, piece_index, begin, data):
         """Send a piece block to the peer"""
         logging.debug(f"Sending piece {piece_index}, offset {begin}, length {len(data)} to {self.peer_id}")
-        payload = piece_index.to_bytes(4, byteorder='big') + \
-                begin.to_bytes(4, byteorder='big') + \
-                data
-        return self._send_message(7, payload)  # 7 = piece
+        return self._send_message(7, _PIECE.pack(piece_index, begin), data)  # 7 = piece
 
     def request_piece(self, piece_index):
         """
@@ -1124,35 +2014,42 @@ class PeerConnection:
             piece_index (int): Chỉ số của piece cần tải xuống
         
         Returns:
-            bool: True nếu request được gửi thành công
+            bool: True nếu các request đã được xếp vào hàng đợi (reactor gửi ở tick kế tiếp)
         """
         # Kiểm tra xem peer có piece này không
-        if not self.peer_bitfield[piece_index]:
+        if not self.peer_has(piece_index):
             return False
             
         # Kiểm tra xem chúng ta đã có piece này chưa
-        if self.piece_manager.have_pieces[piece_index]:
+        if self.piece_manager.has_piece(piece_index):
             return False
             
         # Nếu peer đang choke chúng ta, không thể gửi request
         if self.peer_choking:
             return False
-            
+        
+        # request_queue chỉ được sửa trên thread reactor
+        _get_reactor().call_soon(self._queue_end_game_piece, piece_index)
+        return True
+    
+    def _queue_end_game_piece(self, piece_index):
+        """Put every block of the piece at the front of the request queue (runs on the reactor)"""
+        # Piece có thể đã xong trong lúc chờ reactor: không request lại
+        if not self.connected or self.piece_manager.has_piece(piece_index):
+            return
+        
         # Tạo các request cho từng block của piece
         piece_size = self.piece_manager.piece_length
         block_size = min(16384, piece_size)  # 16KB standard block size
         
         # Thêm các request vào hàng đợi
-        with self.lock:
-            num_blocks = (piece_size + block_size - 1) // block_size
-            for i in range(num_blocks):
-                begin = i * block_size
-                length = min(block_size, piece_size - begin)
-                
-                # Thêm request vào đầu hàng đợi (ưu tiên cao nhất)
-                self.request_queue.appendleft((piece_index, begin, length))
-                
-            logging.debug(f"Đã thêm {num_blocks} blocks cho piece {piece_index} vào hàng đợi (End Game)")
+        num_blocks = (piece_size + block_size - 1) // block_size
+        for i in range(num_blocks):
+            begin = i * block_size
+            length = min(block_size, piece_size - begin)
             
-        return True
+            # Thêm request vào đầu hàng đợi (ưu tiên cao nhất)
+            self.request_queue.appendleft((piece_index, begin, length))
+            
+        logging.debug(f"Đã thêm {num_blocks} blocks cho piece {piece_index} vào hàng đợi (End Game)")
 
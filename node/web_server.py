@@ -1,10 +1,12 @@
 """Web server for P2P node interface"""
 import os
 import json
+import asyncio
 import logging
 import threading
 import tempfile
-from flask import Flask, request, jsonify, render_template, redirect, url_for, send_from_directory
+from functools import lru_cache
+from flask import Flask, Request, request, jsonify, render_template, redirect, url_for, send_from_directory
 from pathlib import Path
 from werkzeug.utils import secure_filename
 
@@ -26,32 +28,69 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from create_torrent import create_metainfo, save_metainfo, create_magnet_link
 from config import TRACKER_URL, WEB_SERVER_PORT, DEFAULT_PEER_PORT
 
+class UploadRequest(Request):
+    """Request ghi các file upload thẳng xuống đĩa trong thư mục uploads khi đang nhận"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if not filename:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        # File tạm nằm cạnh file đích: _save_upload chỉ cần tạo liên kết, không sao chép lại dữ liệu
+        return tempfile.NamedTemporaryFile("wb+", dir=app.config['UPLOAD_FOLDER'], prefix=".upload-")
+
 # Khởi tạo Flask app
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # 1GB limit
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+def _save_upload(file, file_path):
+    """
+    Lưu file upload vào file_path
+    
+    File đã được UploadRequest ghi ra đĩa khi nhận, nên chỉ cần tạo hard link tới file tạm
+    (file tạm tự xóa khi request kết thúc). Nếu không link được (khác ổ đĩa, hệ thống file
+    không hỗ trợ) thì quay về sao chép bằng file.save.
+    
+    Parameters:
+        file (FileStorage): File nhận được từ request.files
+        file_path (str or Path): Đường dẫn đích
+    """
+    stream = file.stream
+    temp_path = getattr(stream, 'name', None)
+    if isinstance(temp_path, str) and os.path.basename(temp_path).startswith(".upload-"):
+        stream.flush()
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            os.link(temp_path, file_path)
+            return
+        except OSError:
+            stream.seek(0)
+    file.save(file_path)
+
 # Khởi tạo peer singleton
 peer = None
 def init_peer(tracker_url=TRACKER_URL, port=DEFAULT_PEER_PORT):
     global peer
     if peer is None:
         peer = Peer(tracker_url=tracker_url, listening_port=port)
-        # Bắt đầu thread kiểm tra trạng thái torrent
-        threading.Thread(target=status_monitor_thread, daemon=True).start()
+        # Chạy vòng theo dõi trạng thái torrent trên một event loop asyncio riêng
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name="status-monitor", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(_monitor(), loop)
     return peer
 
-def status_monitor_thread():
-    """Thread theo dõi trạng thái torrent tự động"""
-    import time
+async def _monitor():
+    """Coroutine theo dõi trạng thái torrent tự động"""
     while True:
         try:
             if peer:
-                peer.check_all_torrents()
+                # check_all_torrents có thể chờ I/O (announce), chạy ngoài event loop
+                await asyncio.to_thread(peer.check_all_torrents)
         except Exception as e:
-            logging.error(f"Error in status monitor thread: {e}")
-        time.sleep(5)  # Kiểm tra mỗi 5 giây
+            logging.error(f"Error in status monitor: {e}")
+        await asyncio.sleep(5)  # Kiểm tra mỗi 5 giây
 
 @app.route("/")
 def index():
@@ -65,6 +104,7 @@ def api_status():
     """API endpoint trả về trạng thái torrent dưới dạng JSON"""
     init_peer()
     info_hash = request.args.get('info_hash')
+    
     status = peer.get_status(info_hash)
     
     # Thêm thông tin MDDT nếu là thông tin chi tiết của một torrent
@@ -73,16 +113,10 @@ def api_status():
         peers = peer.get_peer_stats(info_hash)
         status['connected_peers'] = len([p for p in peers if p.get('connected', False)])
         
-        # Tính toán tốc độ tải xuống/lên hiện tại
-        download_speed = 0
-        upload_speed = 0
-        for p in peers:
-            if p.get('connected', False):
-                download_speed += getattr(p, 'download_speed', 0)
-                upload_speed += getattr(p, 'upload_speed', 0)
-        
+        # Tốc độ tải xuống/lên hiện tại: bộ đếm gộp của torrent, không cần duyệt từng peer
+        download_speed = peer.get_rate(info_hash, 'down')
         status['download_speed'] = download_speed
-        status['upload_speed'] = upload_speed
+        status['upload_speed'] = peer.get_rate(info_hash, 'up')
         
         # Tính hiệu suất MDDT (tỷ lệ tải xuống thực tế so với lý thuyết)
         connected_peers = status['connected_peers']
@@ -157,7 +191,7 @@ def create_torrent_page():
             for file in files:
                 filename = secure_filename(file.filename)
                 file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
+                _save_upload(file, file_path)
                 temp_files.append(file_path)
             
             # Lấy các tham số khác
@@ -165,7 +199,9 @@ def create_torrent_page():
             if not name and len(temp_files) == 1:
                 name = os.path.basename(temp_files[0])
                 
-            piece_length = int(request.form.get('piece_length', 512*1024))
+            # Để trống = tự chọn kích thước piece theo tổng dung lượng
+            piece_length = request.form.get('piece_length')
+            piece_length = int(piece_length) if piece_length else None
             tracker_url = request.form.get('tracker_url', TRACKER_URL)
             
             # Tạo metainfo
@@ -212,7 +248,7 @@ def upload_file():
         os.makedirs(upload_dir, exist_ok=True)
         
         file_path = upload_dir / secure_filename(file.filename)
-        file.save(file_path)
+        _save_upload(file, file_path)
         
         return jsonify({
             "success": True,
@@ -251,12 +287,27 @@ def torrent_details(info_hash):
         info_hash=info_hash
     )
 
+def _unit_index(value, unit_count):
+    """Bậc đơn vị (mỗi bậc 1024) của một số nguyên, tính từ bit_length thay vì chia lặp"""
+    if value < 1024:
+        return 0
+    return min((value.bit_length() - 1) // 10, unit_count - 1)
+
+@lru_cache(maxsize=4096)
+def _format_size_cached(size_bytes):
+    size_names = ["B", "KB", "MB", "GB", "TB"]
+    i = _unit_index(size_bytes, len(size_names))
+    return f"{size_bytes / (1 << (10 * i)):.2f} {size_names[i]}"
+
 @app.template_filter('format_size')
 def format_size(size_bytes):
     """Helper để định dạng kích thước file (bytes -> KB, MB, GB)"""
     if size_bytes == 0:
         return "0B"
-        
+    if isinstance(size_bytes, int):
+        # Kích thước file lặp lại ở mỗi lần render, lấy lại chuỗi đã định dạng từ cache
+        return _format_size_cached(size_bytes)
+    
     size_names = ["B", "KB", "MB", "GB", "TB"]
     i = 0
     while size_bytes >= 1024 and i < len(size_names) - 1:
@@ -277,20 +328,20 @@ def truncate(text, length=10):
         return text
     return text[:length] + '...'
 
+@lru_cache(maxsize=4096)
+def _format_speed_cached(bytes_per_sec):
+    size_names = ["B/s", "KB/s", "MB/s", "GB/s"]
+    i = _unit_index(bytes_per_sec, len(size_names))
+    return f"{bytes_per_sec / (1 << (10 * i)):.2f} {size_names[i]}"
+
 @app.template_filter('format_speed')
 def format_speed(bytes_per_sec):
     """Helper để định dạng tốc độ (B/s -> KB/s, MB/s)"""
     if bytes_per_sec == 0 or bytes_per_sec is None:
         return "0 B/s"
-        
-    size_names = ["B/s", "KB/s", "MB/s", "GB/s"]
-    i = 0
-    speed_value = float(bytes_per_sec)
-    while speed_value >= 1024 and i < len(size_names) - 1:
-        speed_value /= 1024
-        i += 1
     
-    return f"{speed_value:.2f} {size_names[i]}"
+    # Tốc độ EWMA là số thực: làm tròn về byte/s để các giá trị gần nhau dùng chung cache
+    return _format_speed_cached(int(bytes_per_sec))
 
 def shutdown_server():
     """Hàm để dừng server Flask một cách an toàn"""
@@ -301,9 +352,10 @@ def shutdown_server():
 def shutdown():
     """API endpoint để tắt server"""
     try:
-        # Dừng tất cả các torrent đang hoạt động
+        # Dừng tất cả các torrent đang hoạt động, rồi đóng kết nối tới tracker (server sắp thoát)
         if peer:
             peer.stop_all()
+            peer.close()
             
         # Dừng server
         threading.Thread(target=shutdown_server).start()
@@ -326,5 +378,7 @@ if __name__ == "__main__":
     # Khởi tạo peer
     init_peer()
     
-    # Khởi động Flask server
-    app.run(host="0.0.0.0", port=WEB_SERVER_PORT, debug=True)
\ No newline at end of file
+    # Khởi động Flask server (chạy thử); triển khai thật dùng wsgi.py với một WSGI server.
+    # Mỗi request một thread để poll trạng thái không phải chờ upload; tắt debug/reloader
+    # vì reloader chạy module hai lần và tạo hai Peer cùng lắng nghe một cổng
+    app.run(host="0.0.0.0", port=WEB_SERVER_PORT, debug=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""WSGI entry point for the P2P node web interface
+
+Chạy bằng một WSGI server thực thụ thay cho server dev của Flask, ví dụ:
+
+    gunicorn --chdir node -w 1 -k gthread --threads 8 -b 0.0.0.0:5000 wsgi:application
+
+Chỉ dùng một worker process: mỗi process tạo một Peer riêng và Peer lắng nghe trên
+DEFAULT_PEER_PORT, nên nhiều worker sẽ tranh nhau cổng peer. Các thread của worker
+phục vụ song song các request (poll trạng thái, upload) trên cùng một Peer.
+"""
+from web_server import app, init_peer
+
+# Khởi tạo peer ngay khi worker nạp module, không đợi request đầu tiên
+init_peer()
+
+application = app
@@ -0,0 +1,60 @@
+"""Kiểm tra info_hash của tracker và create_torrent phụ thuộc vào nội dung file"""
+import os
+import sys
+import logging
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "tracker"), ROOT]
+
+
+def setUpModule():
+    # create_metainfo của tracker ghi vào thư mục metainfo theo thư mục hiện tại
+    global _old_cwd, metainfo_manager, create_torrent
+    _old_cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    import metainfo_manager
+    import create_torrent
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    os.chdir(_old_cwd)
+
+
+class InfoHashTest(unittest.TestCase):
+    PIECE_LENGTH = 1024
+
+    def write_file(self, folder, content):
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, "f.bin")
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_same_name_and_size_different_content(self):
+        path_a = self.write_file("a", b"A" * 4000)
+        path_b = self.write_file("b", b"B" * 4000)
+
+        hash_a, meta_a = create_torrent.create_metainfo(path_a, piece_length=self.PIECE_LENGTH)
+        hash_b, meta_b = create_torrent.create_metainfo(path_b, piece_length=self.PIECE_LENGTH)
+        self.assertNotEqual(meta_a["pieces"], meta_b["pieces"])
+        self.assertNotEqual(hash_a, hash_b)
+
+        tracker_a, _ = metainfo_manager.create_metainfo(path_a, piece_length=self.PIECE_LENGTH)
+        tracker_b, _ = metainfo_manager.create_metainfo(path_b, piece_length=self.PIECE_LENGTH)
+        self.assertNotEqual(tracker_a, tracker_b)
+
+    def test_tracker_and_create_torrent_agree(self):
+        path = self.write_file("c", os.urandom(3000))
+
+        info_hash, meta = create_torrent.create_metainfo(path, piece_length=self.PIECE_LENGTH)
+        tracker_hash, tracker_meta = metainfo_manager.create_metainfo(path, piece_length=self.PIECE_LENGTH)
+        self.assertEqual(info_hash, tracker_hash)
+        self.assertEqual(metainfo_manager.load_metainfo(tracker_hash)["pieces"], tracker_meta["pieces"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Kiểm tra announce compact đi qua route Flask của tracker tới bộ giải mã của node"""
+import os
+import sys
+import json
+import logging
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "tracker"), os.path.join(ROOT, "node"), ROOT]
+
+
+def setUpModule():
+    # tracker_server/peer tạo file log và thư mục metainfo theo thư mục hiện tại
+    global _old_cwd, tracker_server, state_manager, peer
+    _old_cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    import tracker_server
+    import state_manager
+    import peer
+    logging.disable(logging.CRITICAL)
+
+
+def tearDownModule():
+    logging.disable(logging.NOTSET)
+    os.chdir(_old_cwd)
+
+
+class CompactAnnounceTest(unittest.TestCase):
+    INFO_HASH = "ab" * 20
+
+    def setUp(self):
+        self.client = tracker_server.app.test_client()
+
+    def tearDown(self):
+        for registry in (state_manager.peer_registry, state_manager.compact_registry,
+                         state_manager._swarm_counters):
+            registry.pop(self.INFO_HASH, None)
+
+    def announce(self, peer_id, ip, port, left):
+        payload = {
+            "peer_id": peer_id,
+            "info_hash": self.INFO_HASH,
+            "ip": ip,
+            "port": port,
+            "uploaded": 0,
+            "downloaded": 0,
+            "left": left,
+            "event": "started",
+            "compact": 1
+        }
+        return self.client.post("/announce", data=json.dumps(payload),
+                                content_type="application/json")
+
+    def test_compact_announce_round_trip(self):
+        self.assertEqual(self.announce("seeder", "10.0.0.1", 6881, 0).status_code, 200)
+        self.assertEqual(self.announce("other", "10.0.0.2", 6882, 10).status_code, 200)
+
+        response = self.announce("leecher", "10.0.0.3", 6883, 100)
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertIsInstance(data["peers"], str)
+
+        peers = peer._decode_peers(data["peers"])
+        self.assertEqual(sorted((p["ip"], p["port"]) for p in peers),
+                         [("10.0.0.1", 6881), ("10.0.0.2", 6882)])
+        self.assertTrue(all(p["compact"] and p["peer_id"] == f"{p['ip']}:{p['port']}" for p in peers))
+
+    def test_compact_announce_empty_swarm(self):
+        response = self.announce("alone", "10.0.0.9", 6889, 100)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(peer._decode_peers(response.get_json()["peers"]), [])
+
+    def test_non_compact_peers_pass_through(self):
+        peers = [{"peer_id": "x", "ip": "10.0.0.1", "port": 6881, "left": 0}]
+        self.assertIs(peer._decode_peers(peers), peers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,151 @@
 """Xử lý metainfo cho torrent"""
 import os
 import json
+import math
+import mmap
+import base64
+import struct
 import logging
 import hashlib
+import tempfile
+import threading
+from bisect import bisect_right
+from contextlib import ExitStack
+from itertools import accumulate
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 METAINFO_DIR = Path("metainfo")
+# Kích thước mỗi lần đọc khi băm piece với file không mmap được, độc lập với piece_length
+READ_BLOCK_SIZE = 1 << 20
+# Giới hạn kích thước piece khi tự chọn: 256 KiB .. 16 MiB
+MIN_PIECE_LENGTH = 1 << 18
+MAX_PIECE_LENGTH = 1 << 24
+# Số piece mục tiêu cho một torrent (theo thông lệ BitTorrent ~1000-2000 piece)
+TARGET_PIECE_COUNT = 1500
+
+# Cache metainfo đã đọc: {info_hash: (path, mtime_ns, data)}, kiểm tra lại bằng st_mtime_ns
+_META_CACHE = {}
+# mtime_ns của các file đã đọc khi quét thư mục, để lần quét sau bỏ qua file không đổi
+_SCANNED_MTIMES = {}
+_META_LOCK = threading.RLock()
+
+# Bố cục nhị phân cố định của đầu vào info_hash (little-endian):
+#   header: total_size (u64), piece_length (u64), số file (u32)
+#   mỗi trường chuỗi: độ dài (u32) + UTF-8, mỗi file: path + length (u64)
+#   cuối cùng là khối pieces (20 byte digest mỗi piece)
+_INFO_HEADER = struct.Struct('<QQI')
+_FIELD_LENGTH = struct.Struct('<I')
+_FILE_LENGTH = struct.Struct('<Q')
+
+def compute_info_hash(name, total_size, piece_length, file_infos, pieces):
+    """
+    Tính info_hash từ bố cục nhị phân xác định của các trường metainfo
+    
+    Là cách tính duy nhất, dùng chung cho tracker và create_torrent. Không phụ thuộc vào
+    tên khóa hay thứ tự khóa JSON, nên đổi cách lưu metainfo không làm thay đổi info_hash.
+    pieces thuộc info_hash nên hai torrent cùng tên, cùng kích thước nhưng khác nội dung
+    có info_hash khác nhau; tracker URL thì không.
+    
+    Parameters:
+        name (str): Tên torrent
+        total_size (int): Tổng kích thước các file
+        piece_length (int): Kích thước mỗi phần
+        file_infos (list): Danh sách {"path", "length"} của các file
+        pieces (bytes): Khối digest của các piece (từ calculate_pieces_hash)
+        
+    Returns:
+        str: info_hash dạng hex
+    """
+    buf = bytearray(_INFO_HEADER.pack(total_size, piece_length, len(file_infos)))
+    encoded = name.encode('utf-8')
+    buf += _FIELD_LENGTH.pack(len(encoded))
+    buf += encoded
+    for file_info in file_infos:
+        encoded = file_info["path"].encode('utf-8')
+        buf += _FIELD_LENGTH.pack(len(encoded))
+        buf += encoded
+        buf += _FILE_LENGTH.pack(file_info["length"])
+    
+    # Khối pieces đưa vào bằng update() riêng, không sao chép vào buf
+    h = hashlib.sha1(buf)
+    h.update(pieces)
+    return h.hexdigest()
+
+def _cache_metainfo(path, data):
+    """Ghi (hoặc thay) mục cache của một file metainfo vừa đọc/ghi; gọi khi giữ _META_LOCK"""
+    mtime = path.stat().st_mtime_ns
+    _SCANNED_MTIMES[path] = mtime
+    info_hash = data.get("info_hash")
+    if info_hash:
+        _META_CACHE[info_hash] = (path, mtime, data)
+
+# JSON gọn cho file metainfo: chỉ máy đọc nên không thụt lề
+_dumps_compact = json.JSONEncoder(separators=(',', ':')).encode
+
+def write_metainfo(path, data):
+    """
+    Ghi file metainfo một cách nguyên tử
+    
+    Dữ liệu được ghi vào file tạm cùng thư mục, fsync rồi os.replace đè lên file đích,
+    nên khi tiến trình bị dừng giữa chừng file cũ vẫn còn nguyên, không bị ghi dở, và
+    người đọc (kể cả cache của tracker ở tiến trình khác) không bao giờ thấy file ghi dở.
+    Trong tracker, gọi khi giữ _META_LOCK để cache được cập nhật cùng lúc.
+    
+    Parameters:
+        path (Path): Đường dẫn file metainfo
+        data (dict): Nội dung metainfo (các giá trị phải mã hóa JSON được)
+    """
+    path = Path(path)
+    # Tên file tạm duy nhất (hai tiến trình có thể ghi cùng lúc), không khớp mẫu *.torrent.json khi quét
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with open(fd, 'wb') as f:
+            f.write(_dumps_compact(data).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)  # mkstemp tạo file 0600, file metainfo cần đọc được như trước
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _scan_metainfo_dir():
+    """Đọc các file metainfo mới hoặc đã thay đổi kể từ lần quét trước; gọi khi giữ _META_LOCK"""
+    for file in METAINFO_DIR.glob("*.torrent.json"):
+        try:
+            if _SCANNED_MTIMES.get(file) == file.stat().st_mtime_ns:
+                continue
+            with open(file, 'r') as f:
+                data = json.load(f)
+            _cache_metainfo(file, data)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read metainfo file {file}: {e}")
+
+def _lookup_metainfo(info_hash):
+    """
+    Tìm mục cache của một info_hash, chỉ quét lại thư mục khi chưa có hoặc file đã thay đổi
+    
+    Returns:
+        tuple: (path, mtime_ns, data) hoặc None
+    """
+    with _META_LOCK:
+        entry = _META_CACHE.get(info_hash)
+        if entry is not None:
+            try:
+                if entry[0].stat().st_mtime_ns == entry[1]:
+                    return entry
+            except OSError:
+                pass
+            # File đã bị sửa hoặc xóa: bỏ mục cũ rồi quét lại
+            del _META_CACHE[info_hash]
+            _SCANNED_MTIMES.pop(entry[0], None)
+        
+        _scan_metainfo_dir()
+        return _META_CACHE.get(info_hash)
 
 def load_metainfo(info_hash):
     """
@@ -18,13 +158,9 @@ def load_metainfo(info_hash):
         dict: Dữ liệu metainfo nếu tìm thấy, ngược lại trả về None
     """
     try:
-        # Tìm kiếm trong thư mục metainfo
-        for file in METAINFO_DIR.glob("*.torrent.json"):
-            with open(file, 'r') as f:
-                data = json.load(f)
-                # Kiểm tra xem info_hash có khớp với thông tin trong file không
-                if data.get("info_hash") == info_hash:
-                    return data
+        entry = _lookup_metainfo(info_hash)
+        if entry is not None:
+            return entry[2]
         
         logging.warning(f"No metainfo found for hash: {info_hash}")
         return None
@@ -33,52 +169,112 @@ def load_metainfo(info_hash):
         logging.error(f"Error loading metainfo: {e}")
         return None
 
-def create_metainfo(file_paths, piece_length=512*1024, tracker_url="http://localhost:8000", name=None):
+def load_metainfo_batch(info_hashes):
     """
-    Tạo metainfo cho một hoặc nhiều file torrent và lưu vào thư mục metainfo
+    Tải metainfo của nhiều torrent, quét thư mục metainfo nhiều nhất một lần
+    
+    Parameters:
+        info_hashes (iterable): Các info_hash cần tải
+        
+    Returns:
+        dict: {info_hash: metainfo} cho các info_hash tìm thấy
+    """
+    result = {}
+    try:
+        with _META_LOCK:
+            missing = []
+            for info_hash in set(info_hashes):
+                entry = _META_CACHE.get(info_hash)
+                if entry is not None:
+                    try:
+                        if entry[0].stat().st_mtime_ns == entry[1]:
+                            result[info_hash] = entry[2]
+                            continue
+                    except OSError:
+                        pass
+                    del _META_CACHE[info_hash]
+                    _SCANNED_MTIMES.pop(entry[0], None)
+                missing.append(info_hash)
+            
+            if missing:
+                _scan_metainfo_dir()
+                for info_hash in missing:
+                    entry = _META_CACHE.get(info_hash)
+                    if entry is not None:
+                        result[info_hash] = entry[2]
+    except Exception as e:
+        logging.error(f"Error loading metainfo batch: {e}")
+    return result
+
+def choose_piece_length(total_size):
+    """
+    Chọn kích thước piece theo tổng dung lượng torrent
+    
+    Nhắm tới khoảng TARGET_PIECE_COUNT piece: file lớn dùng piece lớn (tối đa 16 MiB) nên vòng băm
+    chỉ chạy O(1500) lần thay vì O(total/512KiB), danh sách hash cũng nhỏ lại tương ứng;
+    file nhỏ dùng piece 256 KiB để không lãng phí băng thông ở piece cuối.
+    
+    Parameters:
+        total_size (int): Tổng kích thước các file (byte)
+        
+    Returns:
+        int: Kích thước piece (lũy thừa của 2)
+    """
+    if total_size < TARGET_PIECE_COUNT * MIN_PIECE_LENGTH:
+        return MIN_PIECE_LENGTH
+    exponent = int(math.log2(total_size / TARGET_PIECE_COUNT))
+    return max(MIN_PIECE_LENGTH, min(MAX_PIECE_LENGTH, 1 << exponent))
+
+def build_metainfo(file_paths, piece_length, tracker_url, name=None):
+    """
+    Tạo metainfo (kèm pieces và info_hash) cho một hoặc nhiều file, không ghi ra đĩa
+    
+    Dùng chung cho create_metainfo của tracker và của create_torrent.
     
     Parameters:
         file_paths (list): Danh sách đường dẫn đến các file cần tạo metainfo
-        piece_length (int): Kích thước mỗi phần (mặc định 512KB)
+        piece_length (int): Kích thước mỗi phần, None để tự chọn theo tổng kích thước (choose_piece_length)
         tracker_url (str): URL của tracker
         name (str): Tên của torrent, nếu không cung cấp sẽ sử dụng tên thư mục chứa file
         
     Returns:
-        tuple: (info_hash, metainfo) - info_hash là mã băm của thông tin torrent, metainfo là dữ liệu metainfo
+        tuple: (info_hash, metainfo) - trường pieces của metainfo là khối bytes (20 byte mỗi piece)
     """
     if isinstance(file_paths, str):
         file_paths = [file_paths]  # Chuyển đổi string thành list nếu chỉ có một file
         
-    # Kiểm tra tất cả các file tồn tại
-    for file_path in file_paths:
-        path = Path(file_path)
-        if not path.exists():
-            raise FileNotFoundError(f"File not found: {file_path}")
-    
-    # Tính toán tổng kích thước các file
+    # Kiểm tra file tồn tại và tính tổng kích thước trong cùng một lần stat mỗi file
     file_infos = []
     total_size = 0
     
     for file_path in file_paths:
-        path = Path(file_path)
-        file_size = path.stat().st_size
+        try:
+            file_size = os.stat(file_path).st_size
+        except FileNotFoundError:
+            raise FileNotFoundError(f"File not found: {file_path}") from None
         file_infos.append({
-            "path": str(path.name),
+            "path": os.path.basename(file_path),
             "length": file_size
         })
         total_size += file_size
     
+    if piece_length is None:
+        piece_length = choose_piece_length(total_size)
+    
     # Tính toán số lượng phần
     piece_count = (total_size + piece_length - 1) // piece_length
     
     # Xác định tên torrent
     if name is None:
         if len(file_paths) == 1:
-            name = Path(file_paths[0]).name
+            name = file_infos[0]["path"]
         else:
             # Sử dụng tên thư mục chứa nếu các file cùng thư mục
-            common_parent = Path(file_paths[0]).parent
-            name = common_parent.name + "-torrent"
+            common_parent = os.path.dirname(file_paths[0])
+            name = os.path.basename(common_parent) + "-torrent"
+    
+    # Tính hash các piece trước: pieces thuộc info_hash
+    pieces = calculate_pieces_hash(file_paths, piece_length)
     
     # Tạo metainfo
     metainfo = {
@@ -86,92 +282,218 @@ def create_metainfo(file_paths, piece_length=512*1024, tracker_url="http://local
         "piece_length": piece_length,
         "piece_count": piece_count,
         "files": file_infos,
-        "tracker": tracker_url
+        "tracker": tracker_url,
+        "pieces": pieces
     }
     
-    # Tính toán info_hash
-    # Sử dụng SHA1 để tạo info_hash
-    info_hash = hashlib.sha1(json.dumps(metainfo, sort_keys=True).encode()).hexdigest()
+    # Tính toán info_hash từ bố cục nhị phân cố định thay vì JSON sort_keys
+    info_hash = compute_info_hash(name, total_size, piece_length, file_infos, pieces)
     metainfo["info_hash"] = info_hash
     
+    return info_hash, metainfo
+
+def create_metainfo(file_paths, piece_length=512*1024, tracker_url="http://localhost:8000", name=None):
+    """
+    Tạo metainfo cho một hoặc nhiều file torrent và lưu vào thư mục metainfo
+    
+    Parameters:
+        file_paths (list): Danh sách đường dẫn đến các file cần tạo metainfo
+        piece_length (int): Kích thước mỗi phần (mặc định 512KB)
+        tracker_url (str): URL của tracker
+        name (str): Tên của torrent, nếu không cung cấp sẽ sử dụng tên thư mục chứa file
+        
+    Returns:
+        tuple: (info_hash, metainfo) - info_hash là mã băm của thông tin torrent, metainfo là dữ liệu metainfo
+    """
+    info_hash, metainfo = build_metainfo(file_paths, piece_length, tracker_url, name)
+    
+    # Khối pieces được lưu dưới dạng base64 để ghi được vào JSON
+    metainfo["pieces"] = base64.b64encode(metainfo["pieces"]).decode('ascii')
+    
     # Lưu metainfo vào file JSON
     # Tạo thư mục nếu chưa tồn tại
-    output_path = METAINFO_DIR / f"{name}.torrent.json"
+    output_path = METAINFO_DIR / f"{metainfo['name']}.torrent.json"
     os.makedirs(METAINFO_DIR, exist_ok=True)
     
-    with open(output_path, 'w') as f:
-        json.dump(metainfo, f, indent=2)  # indent=2 để dễ đọc hơn
+    with _META_LOCK:
+        write_metainfo(output_path, metainfo)
+        _cache_metainfo(output_path, metainfo)
     
     return info_hash, metainfo
 
-def calculate_pieces_hash(file_paths, piece_length=512*1024):
+def _hash_piece_range(views, out, first_piece, piece_segments):
     """
-    Tính toán hash cho từng piece trong torrent
+    Băm một dải piece liên tiếp và ghi digest trực tiếp vào bộ đệm đã cấp phát sẵn
+    
+    Mỗi worker nhận một dải riêng và ghi vào vùng [20*first_piece, ...) không chồng lấn
+    với các worker khác, nên không cần khóa.
     
     Parameters:
-        file_paths (list): Danh sách đường dẫn đến các file
+        views (list): memoryview của từng file đã mmap (None với file rỗng)
+        out (memoryview): Bộ đệm kết quả, 20 byte mỗi piece
+        first_piece (int): Chỉ số piece đầu tiên của dải
+        piece_segments (list): Các đoạn (file_index, offset, length) của từng piece trong dải
+    """
+    # Gán cục bộ để vòng lặp nóng không phải tra cứu tên global/thuộc tính ở mỗi piece
+    sha1 = hashlib.sha1
+    pos = first_piece * 20
+    for segments in piece_segments:
+        if len(segments) == 1:
+            # Trường hợp phổ biến: piece nằm gọn trong một file, băm ngay qua constructor
+            file_index, offset, length = segments[0]
+            out[pos:pos + 20] = sha1(views[file_index][offset:offset + length]).digest()
+        else:
+            h = sha1()
+            update = h.update
+            for file_index, offset, length in segments:
+                update(views[file_index][offset:offset + length])
+            out[pos:pos + 20] = h.digest()
+        pos += 20
+
+def _piece_segments(file_sizes, piece_length):
+    """
+    Chia dải byte ảo (các file nối tiếp nhau) thành các piece
+    
+    Parameters:
+        file_sizes (list): Kích thước từng file theo thứ tự trong torrent
         piece_length (int): Kích thước mỗi phần
         
-    Returns:
-        list: Danh sách các hash của từng piece
+    Yields:
+        list: Các đoạn (file_index, offset, length) tạo nên một piece
     """
-    if isinstance(file_paths, str):
-        file_paths = [file_paths]
+    # Vị trí bắt đầu của từng file trong dải byte ảo, phần tử cuối là tổng kích thước
+    starts = list(accumulate(file_sizes, initial=0))
+    total_size = starts[-1]
+    
+    for piece_start in range(0, total_size, piece_length):
+        piece_end = min(piece_start + piece_length, total_size)
+        segments = []
+        pos = piece_start
+        while pos < piece_end:
+            # bisect_right bỏ qua các file rỗng (có cùng vị trí bắt đầu với file kế tiếp)
+            file_index = bisect_right(starts, pos) - 1
+            end = min(piece_end, starts[file_index + 1])
+            segments.append((file_index, pos - starts[file_index], end - pos))
+            pos = end
+        yield segments
+
+def _advise_mmap_sequential(fd, mm):
+    """
+    Báo cho kernel biết file đã mmap sẽ được đọc tuần tự từ đầu đến cuối
+    
+    Kernel đọc trước (read-ahead) mạnh hơn và bắt đầu nạp trang vào page cache
+    ngay, nên các thread băm ít phải chờ I/O. Bỏ qua trên nền tảng không hỗ trợ.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    if hasattr(mmap, 'MADV_WILLNEED'):
+        mm.madvise(mmap.MADV_WILLNEED)
+
+def _calculate_pieces_hash_streaming(file_paths, piece_length):
+    """
+    Băm các piece bằng cách đọc tuần tự từng READ_BLOCK_SIZE byte (khi không mmap được file)
     
-    piece_hashes = []
-    current_piece = b""
+    Mỗi piece được băm dần bằng một đối tượng SHA-1, nên piece trải qua ranh giới
+    giữa hai file không cần bộ đệm nối.
+    """
+    piece_hashes = bytearray()
+    buffer = bytearray(READ_BLOCK_SIZE)
+    buffer_view = memoryview(buffer)
+    h = hashlib.sha1()
+    filled = 0  # Số byte của piece hiện tại đã đưa vào h
     
-    # Đọc từng file và tính toán hash cho từng piece
     for file_path in file_paths:
-        with open(file_path, 'rb') as f:
+        # buffering=0: readinto thẳng vào bộ đệm, không qua BufferedReader
+        with open(file_path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
             while True:
-                data = f.read(piece_length - len(current_piece))
-                if not data:
+                n = f.readinto(buffer_view)
+                if not n:
                     break
-                
-                current_piece += data
-                
-                if len(current_piece) == piece_length:
-                    # Tính hash cho piece đủ kích thước
-                    piece_hash = hashlib.sha1(current_piece).hexdigest()
-                    piece_hashes.append(piece_hash)
-                    current_piece = b""
+                pos = 0
+                while pos < n:
+                    take = min(piece_length - filled, n - pos)
+                    h.update(buffer_view[pos:pos + take])
+                    pos += take
+                    filled += take
+                    
+                    if filled == piece_length:
+                        # Tính hash cho piece đủ kích thước
+                        piece_hashes += h.digest()
+                        h = hashlib.sha1()
+                        filled = 0
     
     # Xử lý piece cuối cùng nếu chưa đủ kích thước
-    if current_piece:
-        piece_hash = hashlib.sha1(current_piece).hexdigest()
-        piece_hashes.append(piece_hash)
+    if filled:
+        piece_hashes += h.digest()
     
-    return piece_hashes
+    buffer_view.release()
+    return bytes(piece_hashes)
 
-def update_metainfo_with_pieces(info_hash, piece_hashes):
+def calculate_pieces_hash(file_paths, piece_length=512*1024):
     """
-    Cập nhật metainfo với hash của các piece
+    Tính toán hash cho từng piece trong torrent
+    
+    Mỗi file được mmap một lần và các piece được băm trên memoryview của vùng map
+    (không sao chép). Các piece được chia thành os.cpu_count() dải liên tiếp và băm
+    song song trên các thread (hashlib nhả GIL khi băm buffer lớn hơn 2 KB). Nếu có
+    file không mmap được thì băm tuần tự bằng readinto.
     
     Parameters:
-        info_hash (str): Hash của metainfo cần cập nhật
-        piece_hashes (list): Danh sách các hash của từng piece
+        file_paths (list): Danh sách đường dẫn đến các file
+        piece_length (int): Kích thước mỗi phần
         
     Returns:
-        bool: True nếu cập nhật thành công, False nếu không tìm thấy metainfo
+        bytes: Digest SHA-1 (20 byte) của các piece nối liền nhau, piece i nằm ở [20*i, 20*i+20)
     """
-    try:
-        # Tìm file metainfo theo info_hash
-        for file_path in METAINFO_DIR.glob("*.torrent.json"):
-            with open(file_path, 'r') as f:
-                data = json.load(f)
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    
+    with ExitStack() as stack:
+        # mmap từng file (file rỗng không mmap được và cũng không thuộc piece nào)
+        views = []
+        file_sizes = []
+        for file_path in file_paths:
+            f = stack.enter_context(open(file_path, 'rb'))
+            file_size = os.fstat(f.fileno()).st_size
+            file_sizes.append(file_size)
+            if file_size == 0:
+                views.append(None)
+                continue
+            try:
+                mm = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except (OSError, ValueError) as e:
+                logging.debug(f"Cannot mmap {file_path} ({e}), hashing pieces with sequential reads")
+                break
+            _advise_mmap_sequential(f.fileno(), mm)
+            views.append(stack.enter_context(memoryview(mm)))
+        else:
+            segments = list(_piece_segments(file_sizes, piece_length))
+            if not segments:
+                return b""
+            
+            # Cấp phát sẵn 20 byte cho mỗi piece, các worker ghi digest thẳng vào vị trí của mình
+            buf = bytearray(20 * len(segments))
+            with memoryview(buf) as out:
+                # Ranh giới các dải trùng ranh giới piece, mỗi worker ghi vào vùng riêng của out
+                workers = min(os.cpu_count() or 1, len(segments))
+                chunk = -(-len(segments) // workers)
+                starts = range(0, len(segments), chunk)
                 
-                if data.get("info_hash") == info_hash:
-                    # Cập nhật danh sách piece hashes
-                    data["pieces"] = piece_hashes
-                    
-                    # Ghi lại vào file
-                    with open(file_path, 'w') as f_write:
-                        json.dump(data, f_write, indent=2)
-                    
-                    return True
-        
-        return False
-    except Exception as e:
-        logging.error(f"Error updating metainfo with pieces: {e}")
-        return False
\ No newline at end of file
+                if len(starts) == 1:
+                    _hash_piece_range(views, out, 0, segments)
+                else:
+                    with ThreadPoolExecutor(max_workers=len(starts)) as executor:
+                        # list() để chờ xong và nhận lại ngoại lệ (nếu có) từ các worker
+                        list(executor.map(
+                            lambda start: _hash_piece_range(views, out, start, segments[start:start + chunk]),
+                            starts
+                        ))
+            return bytes(buf)
+    
+    # Có file không mmap được (vòng for dừng bằng break): các map đã mở được đóng ở trên
+    return _calculate_pieces_hash_streaming(file_paths, piece_length)
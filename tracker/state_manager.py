@@ -1,12 +1,127 @@
 """ Quản lý trạng thái các peer theo info_hash"""
+import base64
 import socket
 import struct
 import logging
+import threading
 
 # Dictionary lưu trữ thông tin peer theo info_hash
-# Cấu trúc: {info_hash: [peer1, peer2, ...]}
+# Cấu trúc: {info_hash: {peer_id: peer_info}}, tra cứu/thêm/xóa một peer là O(1)
 peer_registry = {}
 
+_COMPACT_PEER = struct.Struct("!4sH")
+
+class CompactSwarm:
+    """
+    Danh sách peer compact của một swarm, giữ sẵn dưới dạng một khối bytes liền
+    
+    Mỗi peer chiếm một ô 6 byte (IPv4 + port) trong blob, đóng gói một lần khi peer được thêm.
+    Xóa một peer thì chuyển ô cuối vào chỗ trống, nên blob luôn liền mạch và phản hồi compact
+    chỉ là sao chép blob (bỏ qua ô của peer đang hỏi).
+    """
+    
+    __slots__ = ("blob", "slots", "order")
+    
+    def __init__(self):
+        self.blob = bytearray()
+        self.slots = {}   # {peer_id: chỉ số ô}
+        self.order = []   # peer_id theo thứ tự ô
+    
+    def set(self, peer_id, packed):
+        """Ghi (hoặc thay) địa chỉ 6 byte của peer"""
+        index = self.slots.get(peer_id)
+        if index is None:
+            self.slots[peer_id] = len(self.order)
+            self.order.append(peer_id)
+            self.blob += packed
+        else:
+            offset = index * _COMPACT_PEER.size
+            self.blob[offset:offset + _COMPACT_PEER.size] = packed
+    
+    def remove(self, peer_id):
+        """Xóa peer (nếu có), lấp chỗ trống bằng ô cuối cùng"""
+        index = self.slots.pop(peer_id, None)
+        if index is None:
+            return
+        size = _COMPACT_PEER.size
+        last_peer = self.order.pop()
+        if last_peer != peer_id:
+            self.blob[index * size:(index + 1) * size] = self.blob[-size:]
+            self.order[index] = last_peer
+            self.slots[last_peer] = index
+        del self.blob[-size:]
+    
+    def peers_excluding(self, peer_id):
+        """
+        Danh sách compact của mọi peer trừ peer_id
+        
+        Returns:
+            bytes: Các ô 6 byte nối liền
+        """
+        index = self.slots.get(peer_id)
+        if index is None:
+            return bytes(self.blob)
+        offset = index * _COMPACT_PEER.size
+        # Một lần sao chép từ hai lát của blob (view phải được nhả trước khi blob đổi kích thước)
+        with memoryview(self.blob) as view:
+            return b"".join((view[:offset], view[offset + _COMPACT_PEER.size:]))
+
+# Danh sách compact của mỗi swarm, cập nhật cùng lúc với peer_registry
+# Cấu trúc: {info_hash: CompactSwarm}; peer có IP/port không hợp lệ không có mặt ở đây
+compact_registry = {}
+
+# Số seeder/leecher của mỗi swarm, cập nhật cùng lúc với peer_registry (dưới lock của swarm)
+# Cấu trúc: {info_hash: [seeders, leechers]}
+_swarm_counters = {}
+
+# Các trường cố định của phản hồi announce, mỗi lần chỉ sao chép (một lần copy ở mức C)
+_RESPONSE_TEMPLATE = {
+    "tracker_id": "simple_tracker_v1",
+    "failure_reason": None
+}
+
+def _adjust_counts(counters, left, delta):
+    """Cộng delta vào bộ đếm seeder (left == 0) hoặc leecher (left > 0) ứng với giá trị left"""
+    if left == 0:
+        counters[0] += delta
+    elif left > 0:
+        counters[1] += delta
+
+# Mỗi swarm một lock: announce của các torrent khác nhau không chặn nhau
+# Cấu trúc: {info_hash: threading.Lock}
+_swarm_locks = {}
+
+def _swarm_lock(info_hash):
+    """Lấy (tạo nếu chưa có) lock của swarm; dict.setdefault là atomic nên hai thread luôn nhận cùng một lock"""
+    lock = _swarm_locks.get(info_hash)
+    if lock is None:
+        lock = _swarm_locks.setdefault(info_hash, threading.Lock())
+    return lock
+
+def _pack_compact(peer_info):
+    """
+    Đóng gói địa chỉ của peer cho compact mode
+    
+    Parameters:
+        peer_info (dict): Thông tin peer đã lưu
+        
+    Returns:
+        bytes: 6 byte IP + port, hoặc None nếu không đóng gói được
+    """
+    try:
+        return _COMPACT_PEER.pack(socket.inet_aton(peer_info["ip"]), peer_info["port"])
+    except (OSError, TypeError, struct.error) as e:
+        logging.warning(f"Error compacting peer {peer_info['ip']}:{peer_info['port']}: {e}")
+        return None
+
+def _store_compact(compact_swarm, peer_id, peer_info):
+    """Cập nhật địa chỉ compact của một peer vừa được thêm/thay thông tin"""
+    packed = _pack_compact(peer_info)
+    if packed is None:
+        compact_swarm.remove(peer_id)
+    else:
+        compact_swarm.set(peer_id, packed)
+
 def manage_peer(peer):
     """
     Quản lý các peer dựa trên loại event và info_hash
@@ -24,10 +139,6 @@ def manage_peer(peer):
     peer_id = peer.get("peer_id")
     compact = int(peer.get("compact", 0))
 
-    # Khởi tạo danh sách trống nếu info_hash chưa tồn tại
-    if info_hash not in peer_registry:
-        peer_registry[info_hash] = []
-
     # Chuẩn bị thông tin peer để lưu trữ (chỉ những thông tin cần thiết)
     peer_info = {
         "peer_id": peer.get("peer_id"),
@@ -36,57 +147,60 @@ def manage_peer(peer):
         "left": int(peer.get("left"))  # Để biết peer là seeder hay leecher
     }
 
-    # Xử lý theo loại event
-    if event == "started":
-        # Kiểm tra nếu peer đã tồn tại, cập nhật thông tin
-        existing_peer = next((p for p in peer_registry[info_hash] if p["peer_id"] == peer_id), None)
-        if existing_peer:
-            # Cập nhật thông tin peer hiện có
-            existing_peer.update(peer_info)
-        else:
-            # Thêm peer mới vào danh sách
-            peer_registry[info_hash].append(peer_info)
+    # Mọi thay đổi và lần đọc swarm đều nằm trong lock của swarm đó
+    with _swarm_lock(info_hash):
+        # Khởi tạo swarm trống nếu info_hash chưa tồn tại
+        swarm = peer_registry.get(info_hash)
+        if swarm is None:
+            swarm = peer_registry[info_hash] = {}
+        compact_swarm = compact_registry.get(info_hash)
+        if compact_swarm is None:
+            compact_swarm = compact_registry[info_hash] = CompactSwarm()
+        counters = _swarm_counters.setdefault(info_hash, [0, 0])
+
+        # Xử lý theo loại event
+        if event == "started":
+            # Thêm peer mới hoặc thay thông tin của peer đã có
+            existing_peer = swarm.get(peer_id)
+            if existing_peer is not None:
+                _adjust_counts(counters, existing_peer["left"], -1)
+            swarm[peer_id] = peer_info
+            _adjust_counts(counters, peer_info["left"], 1)
+            _store_compact(compact_swarm, peer_id, peer_info)
             
-    elif event == "completed":
-        # Đánh dấu peer là seeder (left = 0)
-        existing_peer = next((p for p in peer_registry[info_hash] if p["peer_id"] == peer_id), None)
-        if existing_peer:
+        elif event == "completed":
+            # Đánh dấu peer là seeder (left = 0), thêm mới nếu chưa có
+            existing_peer = swarm.get(peer_id)
+            if existing_peer is None:
+                existing_peer = swarm[peer_id] = peer_info
+                _store_compact(compact_swarm, peer_id, peer_info)
+            else:
+                _adjust_counts(counters, existing_peer["left"], -1)
             existing_peer["left"] = 0
-        else:
-            # Nếu không tìm thấy, thêm mới với left = 0
-            peer_info["left"] = 0
-            peer_registry[info_hash].append(peer_info)
+            _adjust_counts(counters, 0, 1)
             
-    elif event == "stopped":
-        # Xóa peer khỏi danh sách
-        peer_registry[info_hash] = [p for p in peer_registry[info_hash] if p["peer_id"] != peer_id]
-    
-    # Chỉ trả về danh sách các peer khác, không bao gồm peer hiện tại
-    other_peers = [p for p in peer_registry[info_hash] if p["peer_id"] != peer_id]
-    
-    response = {
-        "tracker_id": "simple_tracker_v1",
-        "failure_reason": None
-    }
-    
-    # Hỗ trợ compact mode - nén danh sách peer thành dạng binary
-    if compact:
-        compact_peers = b""
-        for p in other_peers:
-            try:
-                # Chuyển IP từ string sang 4 bytes
-                ip_bytes = socket.inet_aton(p["ip"])
-                # Chuyển port thành 2 bytes
-                port_bytes = struct.pack("!H", p["port"])
-                compact_peers += ip_bytes + port_bytes
-            except Exception as e:
-                logging.warning(f"Error compacting peer {p['ip']}:{p['port']}: {e}")
-                continue
-        response["peers"] = compact_peers
-    else:
-        # Dictionary model (mode không nén)
-        response["peers"] = other_peers
-    
+        elif event == "stopped":
+            # Xóa peer khỏi swarm
+            existing_peer = swarm.pop(peer_id, None)
+            if existing_peer is not None:
+                _adjust_counts(counters, existing_peer["left"], -1)
+            compact_swarm.remove(peer_id)
+        
+        response = _RESPONSE_TEMPLATE.copy()
+        
+        # Chỉ trả về danh sách các peer khác, không bao gồm peer hiện tại. Mỗi mode tự lọc
+        # trong lần duyệt của mình, không dựng trước danh sách other_peers
+        if compact:
+            # Hỗ trợ compact mode - sao chép khối địa chỉ đã đóng gói sẵn (không duyệt từng peer).
+            # JSON không chứa được bytes nên khối được gửi dưới dạng chuỗi base64
+            response["peers"] = base64.b64encode(compact_swarm.peers_excluding(peer_id)).decode('ascii')
+        elif peer_id in swarm:
+            # Dictionary model (mode không nén)
+            response["peers"] = [p for pid, p in swarm.items() if pid != peer_id]
+        else:
+            # Peer không có trong swarm (vd. vừa stopped): sao chép thẳng, không so sánh từng khóa
+            response["peers"] = list(swarm.values())
+        
     return response
 
 def get_stats():
@@ -104,9 +218,28 @@ def get_stats():
         "leechers": 0
     }
     
-    for info_hash, peers in peer_registry.items():
+    # Cộng các bộ đếm có sẵn, không duyệt peer. Duyệt trên bản sao: announce ở thread khác
+    # có thể thêm swarm mới
+    for peers in list(peer_registry.values()):
         stats["peers"] += len(peers)
-        stats["seeders"] += sum(1 for p in peers if p["left"] == 0)
-        stats["leechers"] += sum(1 for p in peers if p["left"] > 0)
+    for seeders, leechers in list(_swarm_counters.values()):
+        stats["seeders"] += seeders
+        stats["leechers"] += leechers
+        
+    return stats
+
+def get_swarm_counts(info_hash):
+    """
+    Đếm seeder và leecher của một swarm
+    
+    Parameters:
+        info_hash (str): Info hash của torrent
         
-    return stats
\ No newline at end of file
+    Returns:
+        tuple: (seeders, leechers)
+    """
+    counters = _swarm_counters.get(info_hash)
+    if counters is None:
+        return 0, 0
+    with _swarm_lock(info_hash):
+        return counters[0], counters[1]
\ No newline at end of file
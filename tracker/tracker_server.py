@@ -1,11 +1,13 @@
 """ Xử lí các request của Peers"""
+import json
+import hashlib
 import logging
-from flask import Flask, request, jsonify, render_template  # flask: Thư viện cho giao thức HTTP 
-                                                            # request: hàm lấy các yêu cầu gửi đến TRACKER
-                                                            # jsonify: hàm để phản hồi file JSON cho các PEER
+from flask import Flask, Response, request, render_template  # flask: Thư viện cho giao thức HTTP 
+                                                             # request: hàm lấy các yêu cầu gửi đến TRACKER
+                                                             # Response: phản hồi file JSON cho các PEER
 from tracker_utils import (validate_announce_payload)
-from state_manager import (manage_peer, get_stats, peer_registry)
-from metainfo_manager import load_metainfo
+from state_manager import (manage_peer, get_stats, get_swarm_counts, peer_registry)
+from metainfo_manager import load_metainfo, load_metainfo_batch
 
 # Cấu hình logging
 logging.basicConfig(
@@ -19,6 +21,51 @@ logging.basicConfig(
 
 app = Flask(__name__)
 
+# Bộ mã hóa JSON dùng lại cho mọi phản hồi: dạng gọn, không sắp xếp khóa như jsonify
+_dumps_compact = json.JSONEncoder(separators=(',', ':')).encode
+
+def jsonify(data):
+    """
+    Tạo phản hồi JSON (thay cho flask.jsonify)
+    
+    Parameters:
+        data: Dữ liệu cần mã hóa
+        
+    Returns:
+        Response: Phản hồi với mimetype application/json
+    """
+    return Response(_dumps_compact(data), mimetype='application/json')
+
+# Khung phản hồi lỗi của announce: chỉ failure_reason thay đổi
+_ANNOUNCE_FAILURE = {
+    "failure_reason": None,
+    "warning": None,
+    "peers": [],
+    "tracker_id": None
+}
+# Body JSON đã mã hóa theo failure_reason; các lý do lỗi là một tập nhỏ cố định
+_ANNOUNCE_FAILURE_BODIES = {}
+
+def _announce_failure(failure_reason):
+    """
+    Tạo phản hồi lỗi 400 cho announce
+    
+    Parameters:
+        failure_reason (str): Lý do lỗi
+        
+    Returns:
+        tuple: (Response, 400)
+    """
+    body = _ANNOUNCE_FAILURE_BODIES.get(failure_reason)
+    if body is None:
+        body = _dumps_compact(dict(_ANNOUNCE_FAILURE, failure_reason=failure_reason))
+        _ANNOUNCE_FAILURE_BODIES[failure_reason] = body
+    return Response(body, mimetype='application/json'), 400
+
+# Body JSON đã mã hóa của /metainfo: {info_hash: (metainfo, body, etag)}. Chỉ dùng lại khi load_metainfo
+# trả về đúng đối tượng metainfo đó (cache của metainfo_manager tạo dict mới mỗi khi file thay đổi)
+_METAINFO_BYTES_CACHE = {}
+
 @app.route("/", methods=['GET'])
 def index():
     """Trang chủ hiển thị thống kê của tracker"""
@@ -39,27 +86,18 @@ def announce():
     
     # Kiểm tra file JSON có đúng chuẩn chưa
     try:
-        request_data = request.get_json(force=True)
+        # Giải mã thẳng từ body (json C), không giữ lại bản sao body trong request
+        request_data = json.loads(request.get_data(cache=False))
         logging.debug(f"Request data: {request_data}")
     except Exception as e:
         logging.error(f"Error parsing JSON: {e}")
-        return jsonify({
-            "failure_reason": "Invalid JSON format",
-            "warning": None,
-            "peers": [],
-            "tracker_id": None
-        }), 400
+        return _announce_failure("Invalid JSON format")
     
     # Kiểm tra failure
     failure_reason, warning = validate_announce_payload(request_data)
     if failure_reason:
         logging.warning(f"Invalid request: {failure_reason}")
-        return jsonify({
-            "failure_reason": failure_reason,
-            "warning": None,
-            "peers": [],
-            "tracker_id": None
-        }), 400
+        return _announce_failure(failure_reason)
 
     # Trả về phản hồi của TRACKER
     peer_response = manage_peer(request_data)
@@ -81,11 +119,12 @@ def scrape():
     
     if info_hash:
         # Trả về thông tin cụ thể cho info_hash
+        seeders, leechers = get_swarm_counts(info_hash)
         return jsonify({
             "files": {
                 info_hash: {
-                    "complete": sum(1 for p in peer_registry.get(info_hash, []) if p["left"] == 0),
-                    "incomplete": sum(1 for p in peer_registry.get(info_hash, []) if p["left"] > 0),
+                    "complete": seeders,
+                    "incomplete": leechers,
                     "downloaded": 0  # Cần theo dõi thêm số lần tải xuống hoàn chỉnh
                 }
             }
@@ -100,6 +139,9 @@ def scrape():
 def get_metainfo():
     """
     Cung cấp thông tin metainfo cho một torrent cụ thể
+    
+    ETag là SHA-1 của body chứ không phải info_hash: cùng một torrent, file metainfo vẫn có thể
+    được ghi lại (ví dụ đổi tracker URL). Client gửi If-None-Match khớp sẽ nhận 304 không body.
     """
     info_hash = request.args.get('info_hash')
     
@@ -111,11 +153,44 @@ def get_metainfo():
     metainfo = load_metainfo(info_hash)
     
     if not metainfo:
+        _METAINFO_BYTES_CACHE.pop(info_hash, None)
         return jsonify({
             "failure_reason": "Metainfo not found"
         }), 404
     
-    return jsonify(metainfo), 200
+    cached = _METAINFO_BYTES_CACHE.get(info_hash)
+    if cached is not None and cached[0] is metainfo:
+        _, body, etag = cached
+    else:
+        body = _dumps_compact(metainfo).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        _METAINFO_BYTES_CACHE[info_hash] = (metainfo, body, etag)
+    
+    # no-cache: client được giữ bản sao nhưng phải hỏi lại (rẻ, chỉ 304) vì metainfo có thể đổi
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route("/metainfo_batch", methods=['POST'])
+def get_metainfo_batch():
+    """
+    Cung cấp metainfo của nhiều torrent trong một request
+    
+    Body JSON: {"info_hashes": [...]}, phản hồi: {info_hash: metainfo} cho các torrent tìm thấy
+    """
+    request_data = request.get_json(force=True, silent=True)
+    info_hashes = request_data.get("info_hashes") if isinstance(request_data, dict) else None
+    
+    if not isinstance(info_hashes, list) or not all(isinstance(h, str) for h in info_hashes):
+        return jsonify({
+            "failure_reason": "Missing or invalid info_hashes list"
+        }), 400
+    
+    return jsonify(load_metainfo_batch(info_hashes)), 200
 
 
 @app.route("/stats", methods=['GET'])
@@ -126,12 +201,13 @@ def stats_page():
     stats = get_stats()
     torrents = {}
     
-    # Get details for each torrent
-    for info_hash in peer_registry:
-        metainfo = load_metainfo(info_hash)
+    # Get details for each torrent: tải metainfo của mọi torrent trong một lần
+    info_hashes = list(peer_registry)
+    metainfos = load_metainfo_batch(info_hashes)
+    for info_hash in info_hashes:
+        metainfo = metainfos.get(info_hash)
         if metainfo:
-            seeders = sum(1 for p in peer_registry[info_hash] if p["left"] == 0)
-            leechers = sum(1 for p in peer_registry[info_hash] if p["left"] > 0)
+            seeders, leechers = get_swarm_counts(info_hash)
             
             torrents[info_hash] = {
                 "name": metainfo.get("name", "Unknown"),
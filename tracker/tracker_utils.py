@@ -1,25 +1,68 @@
 """ Kiểm tra request của Peers"""
+import re
+import ipaddress
+
+REQUIRED_FIELDS = ("peer_id", "event", "info_hash", "ip", "port", "downloaded", "left", "uploaded", "compact")
+_REQUIRED_SET = frozenset(REQUIRED_FIELDS)
+INT_FIELDS = ("port", "downloaded", "left", "uploaded")
+# Chuỗi số nguyên được chấp nhận cho các trường số (không nhận "1.7", " 1", "1_000")
+_INT_STRING = re.compile(r'-?[0-9]+')
+
+def _is_valid_ip(ip):
+    """
+    Địa chỉ IPv4 (đủ 4 số thập phân) hoặc IPv6 hợp lệ
+    
+    Dùng ipaddress thay vì inet_aton: inet_aton nhận cả dạng rút gọn như "1" hay "127.1".
+    Tên máy (hostname) không được chấp nhận, peer phải announce bằng địa chỉ IP.
+    """
+    if not isinstance(ip, str):
+        return False
+    try:
+        ipaddress.ip_address(ip)
+        return True
+    except ValueError:
+        return False
 
 def validate_announce_payload(payload):
-    required_fields = ["peer_id", "event", "info_hash", "ip", "port", "downloaded", "left", "uploaded", "compact"]
-    missing_fields = [field for field in required_fields if field not in payload]
+    """
+    Kiểm tra payload announce và chuẩn hóa các trường số về int (ngay trong payload)
+    
+    Parameters:
+        payload (dict): Dữ liệu JSON đã giải mã từ peer
+        
+    Returns:
+        tuple: (failure_reason, warning), failure_reason là None nếu payload hợp lệ
+    """
+    if not isinstance(payload, dict):
+        return "Payload must be a JSON object", None
 
-    if missing_fields:
+    # Kiểm tra tập khóa một lần ở mức C, chỉ dựng danh sách trường thiếu khi có lỗi
+    if not _REQUIRED_SET.issubset(payload):
+        missing_fields = [field for field in REQUIRED_FIELDS if field not in payload]
         return f"Missing fields: {', '.join(missing_fields)}", None
 
-    # Kiểm tra các trường bắt buộc
-    try:
-        int(payload["port"])
-        int(payload["downloaded"])
-        int(payload["left"])
-        int(payload["uploaded"])
-    except ValueError:
-        return "Invalid type for port/downloaded/left/uploaded", None
+    # Kiểm tra các trường bắt buộc: chỉ nhận int thật (type() loại bool) hoặc chuỗi số nguyên,
+    # không làm tròn float. Giá trị đã là int (trường hợp phổ biến) được giữ nguyên
+    for field in INT_FIELDS:
+        value = payload[field]
+        if type(value) is int:
+            continue
+        if isinstance(value, str) and _INT_STRING.fullmatch(value):
+            payload[field] = int(value)
+        else:
+            return "Invalid type for port/downloaded/left/uploaded", None
+
+    # Kiểm tra địa chỉ ngay khi nhận, để peer lỗi không vào registry (và compact mode không phải
+    # bắt ngoại lệ khi đóng gói). Peer IPv6 vẫn được lưu nhưng chỉ có trong danh sách không nén
+    if not _is_valid_ip(payload["ip"]):
+        return "Invalid ip", None
+    if not 0 <= payload["port"] <= 65535:
+        return "Invalid port", None
 
     # Kiểm tra compact mode
     # compact=1 có nghĩa là client hỗ trợ danh sách nén theo bytes
     warning = None
-    if "compact" in payload and payload["compact"] != 1:
+    if payload["compact"] != 1:
         warning = "compact value should be 1, using compact mode by default"
 
-    return None, warning
\ No newline at end of file
+    return None, warning
@@ -0,0 +1,13 @@
+"""WSGI entry point for the tracker
+
+Chạy bằng một WSGI server thực thụ thay cho server dev của Flask, ví dụ:
+
+    gunicorn --chdir tracker -w 1 -k gthread --threads 16 -b 0.0.0.0:8000 wsgi:application
+
+Chỉ dùng một worker process: peer_registry nằm trong bộ nhớ của process, nhiều worker sẽ
+mỗi worker giữ một danh sách peer riêng. Các thread của worker xử lý announce song song,
+mỗi swarm được bảo vệ bằng lock riêng (xem state_manager).
+"""
+from tracker_server import app
+
+application = app